@@ -101,6 +101,16 @@ class MappedColorRamp(object):
         """
         return int(self.alpha * self.MAX_HEX_DECIMAL)
 
+    def getPngPalette(self):
+        """
+        Return the palette of an indexed color PNG: the ramp colors followed by a transparent entry for no data values,
+        with the alpha of each entry.
+        :rtype: (list of RGB tuples, list of alpha integers)
+        """
+        colors = [tuple(rgb) for rgb in self.colorRamp] + [(0, 0, 0)]
+        alphas = [self.getAlphaAsInteger()] * len(self.colorRamp) + [0]
+        return colors, alphas
+
     def getPostGisColorRampString(self):
         # Join strings in list to create ramp
         return '\n'.join(self.vrgbaList)
@@ -181,6 +191,34 @@ class MappedColorRamp(object):
 
 
 
+class ColorRampMixin(object):
+    """
+    Color ramp methods of the converters. The color ramp is stored as a list of RGB tuples in the _colorRamp attribute.
+    """
+
+    def setColorRamp(self, colorRamp=None):
+        """
+        Set the color ramp of the converter instance (defaults to the hue color ramp)
+        """
+        if not colorRamp:
+            self.setDefaultColorRamp(ColorRampEnum.COLOR_RAMP_HUE)
+        else:
+            self._colorRamp = colorRamp
+
+    def setDefaultColorRamp(self, colorRampEnum=ColorRampEnum.COLOR_RAMP_HUE):
+        """
+        Returns the color ramp as a list of RGB tuples
+        """
+        self._colorRamp = ColorRampGenerator.generateDefaultColorRamp(colorRampEnum)
+
+    def setCustomColorRamp(self, colors=[], interpolatedPoints=10):
+        """
+        Accepts a list of RGB tuples and interpolates between them to create a custom color ramp.
+        Returns the color ramp as a list of RGB tuples.
+        """
+        self._colorRamp = ColorRampGenerator.generateCustomColorRamp(colors, interpolatedPoints)
+
+
 class ColorRampGenerator(object):
     """
     An instance of the ColorRampGenerator can be used to generate and manipulate color ramps in MapKit
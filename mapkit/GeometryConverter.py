@@ -11,34 +11,32 @@
 import math
 import xml.etree.ElementTree as ET
 
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.engine import Engine
-from sqlalchemy.orm.session import Session
+from mapkit import formatCoordinate
+from mapkit.SessionManager import SessionManager, sessionPerCall
+from mapkit.sqlautils import prepareStatement
 
 
-class GeometryConverter(object):
+class GeometryConverter(SessionManager):
     """
     An instance of GeometryConverter can be used to extract PostGIS
     geometry layers from a database and convert them into different formats
     for visualization.
     """
 
-    def __init__(self, sqlAlchemyEngineOrSession):
+    def __init__(self, sqlAlchemyEngineOrSession, threadSafe=False):
         """
         Constructor
+        :param sqlAlchemyEngineOrSession: SQLAlchemy engine or session bound to a PostGIS enabled database
+        :param threadSafe: Check out a session from the engine for each call so the instance can be shared by many threads (requires an engine)
         """
-        # Create sqlalchemy session
-        if isinstance(sqlAlchemyEngineOrSession, Engine):
-            sessionMaker = sessionmaker(bind=sqlAlchemyEngineOrSession)
-            self._session = sessionMaker()
-        elif isinstance(sqlAlchemyEngineOrSession, Session):
-            self._session = sqlAlchemyEngineOrSession
+        super(GeometryConverter, self).__init__(sqlAlchemyEngineOrSession, threadSafe=threadSafe)
 
+    @sessionPerCall
     def getPointAsKmlCircle(self, tableName, radius, slices=25, extrude=0, zScaleFactor=1.0, geometryId=1,
-                            geometryIdFieldName='id', geometryFieldName='geometry'):
+                            geometryIdFieldName='id', geometryFieldName='geometry', precision=None):
         """
         Return a string representing a circular polygon in KML format with center at the coordinates of the point
-        and radius as specified.
+        and radius as specified. Pass precision to limit the number of decimal places of the coordinates.
         """
         # Validate
 
@@ -46,13 +44,13 @@ class GeometryConverter(object):
         PI2 = 2 * math.pi
 
         # Get coordinates
-        statement = '''
-                    SELECT ST_X(ST_Transform({0}, 4326)) as x, ST_Y(ST_Transform({0}, 4326)) as y, ST_Z(ST_Transform({0}, 4326)) as z
-                    FROM {1}
-                    WHERE {2}={3};
-                    '''.format(geometryFieldName, tableName, geometryIdFieldName, geometryId)
+        statement = prepareStatement('''
+                    SELECT ST_X(ST_Transform({geometry}, 4326)) as x, ST_Y(ST_Transform({geometry}, 4326)) as y, ST_Z(ST_Transform({geometry}, 4326)) as z
+                    FROM {table}
+                    WHERE {geometryId}=:geometryId;
+                    ''', geometry=geometryFieldName, table=tableName, geometryId=geometryIdFieldName)
 
-        result = self._session.execute(statement)
+        result = self._session.execute(statement, {'geometryId': geometryId})
 
         centerLatitude= 0.0
         centerLongitude = 0.0
@@ -72,7 +70,9 @@ class GeometryConverter(object):
             if extrude and zScaleFactor:
                 elevation = extrude * zScaleFactor
 
-            coordinatesString += '{0},{1},{2} '.format(latitude, longitude, elevation)
+            coordinatesString += '{0},{1},{2} '.format(formatCoordinate(latitude, precision),
+                                                       formatCoordinate(longitude, precision),
+                                                       formatCoordinate(elevation, precision))
 
         # Create polygon element
         polygon = ET.Element('Polygon')
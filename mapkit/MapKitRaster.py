@@ -9,8 +9,9 @@
 '''
 
 from mapkit import Base
-from .sqlatypes import Raster
-from sqlalchemy import Column, Integer, String, DateTime
+from .sqlatypes import Raster, Geometry
+from sqlalchemy import Column, Integer, String, DateTime, Float, Index
+from sqlalchemy.orm import deferred, undefer
 
 class MapKitRaster(Base):
     '''
@@ -18,12 +19,64 @@ class MapKitRaster(Base):
     '''
     __tablename__ = 'map_kit_rasters'
 
+    __table_args__ = (Index('idx_map_kit_rasters_footprint', 'footprint', postgresql_using='gist'),)
+
     id = Column(Integer, primary_key=True)
     filename = Column(String)
-    timestamp = Column(DateTime)
-    raster = Column(Raster)
+    timestamp = Column(DateTime, index=True)
+    # Deferred: only loaded when accessed or requested with MapKitRaster.withRaster()
+    raster = deferred(Column(Raster))
+
+    # Metadata and statistics derived from the raster at load time (see RasterLoader.updateRasterMetadata)
+    width = Column(Integer)
+    height = Column(Integer)
+    srid = Column(Integer, index=True)
+    upper_left_x = Column(Float)
+    upper_left_y = Column(Float)
+    scale_x = Column(Float)
+    scale_y = Column(Float)
+    skew_x = Column(Float)
+    skew_y = Column(Float)
+    no_data_value = Column(Float)
+    min_value = Column(Float, index=True)
+    max_value = Column(Float, index=True)
+    footprint = Column(Geometry)
 
     def __repr__(self):
-        return '<MapKitRaster(filename={0}, timestamp={1}, raster={2}>'.format(self.filename,
-                                                                              self.timestamp,
-                                                                              self.raster)
+        return '<MapKitRaster(id={0}, filename={1}, timestamp={2}>'.format(self.id,
+                                                                         self.filename,
+                                                                         self.timestamp)
+
+    @classmethod
+    def queryMetadata(cls, session):
+        """
+        Return a query for the id, filename, timestamp and metadata columns only, ordered by timestamp. The raster
+        column is never transferred.
+        :param session: SQLAlchemy session object bound to a PostGIS enabled database
+        """
+        return session.query(cls.id, cls.filename, cls.timestamp,
+                             cls.width, cls.height, cls.srid,
+                             cls.no_data_value, cls.min_value, cls.max_value).order_by(cls.timestamp, cls.id)
+
+    @classmethod
+    def listTimestamps(cls, session, filename=None):
+        """
+        Return a list of (id, timestamp) tuples ordered by timestamp, optionally filtered by filename.
+        :param session: SQLAlchemy session object bound to a PostGIS enabled database
+        :param filename: Only list rasters with this filename
+        """
+        query = session.query(cls.id, cls.timestamp)
+
+        if filename is not None:
+            query = query.filter(cls.filename == filename)
+
+        return [(row.id, row.timestamp) for row in query.order_by(cls.timestamp, cls.id)]
+
+    @classmethod
+    def withRaster(cls, session):
+        """
+        Return a query for MapKitRaster objects that loads the raster column up front (e.g.: when every raster will
+        be accessed anyway).
+        :param session: SQLAlchemy session object bound to a PostGIS enabled database
+        """
+        return session.query(cls).options(undefer(cls.raster))
@@ -0,0 +1,69 @@
+"""
+********************************************************************************
+* Name: PngWriter
+* Author: Nathan Swain
+* Created On: October 18, 2026
+* Copyright: (c) Brigham Young University 2013
+* License: BSD 2-Clause
+********************************************************************************
+"""
+import struct
+import zlib
+
+from mapkit.WKBRasterReader import WKBRasterReader
+
+
+class PngWriter(object):
+    """
+    Writes 8-bit palette (indexed color) PNG images from the 8BUI band of a raster, where each cell value is an index
+    into the palette.
+    """
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+    MAX_PALETTE_SIZE = 256
+
+    @classmethod
+    def getPalettePng(cls, rasterReader, colors, alphas, bandNumber=1, compressionLevel=6):
+        """
+        Return a palette PNG of a band of the raster.
+        :param rasterReader: WKBRasterReader of the raster
+        :param colors: List of RGB tuples of the palette
+        :param alphas: List of the alpha (0-255) of each palette entry (tRNS chunk)
+        :param bandNumber: Band with the palette indices (must be 8BUI)
+        :param compressionLevel: zlib compression level (0-9)
+        :rtype: bytes
+        """
+        band = rasterReader.getBand(bandNumber)
+
+        if WKBRasterReader.PIXEL_TYPES[band.pixelType][0] != '8BUI':
+            raise ValueError('PNG WRITE ERROR: palette PNGs require an 8BUI band.')
+
+        if not 0 < len(colors) <= cls.MAX_PALETTE_SIZE:
+            raise ValueError('PNG WRITE ERROR: a palette must have between 1 and {0} colors.'.format(cls.MAX_PALETTE_SIZE))
+
+        # Each scanline starts with its filter type (0 = None)
+        compressor = zlib.compressobj(compressionLevel)
+        imageData = []
+
+        for row in band.iterRows():
+            imageData.append(compressor.compress(b'\x00' + row.tobytes()))
+
+        imageData.append(compressor.flush())
+
+        # Width, height, bit depth, color type 3 (palette), compression, filter and interlace methods
+        header = struct.pack('>IIBBBBB', band.width, band.height, 8, 3, 0, 0, 0)
+        palette = b''.join(struct.pack('BBB', *rgb) for rgb in colors)
+        transparency = bytes(bytearray(int(alpha) for alpha in alphas))
+
+        return b''.join((cls.SIGNATURE,
+                         cls._getChunk(b'IHDR', header),
+                         cls._getChunk(b'PLTE', palette),
+                         cls._getChunk(b'tRNS', transparency),
+                         cls._getChunk(b'IDAT', b''.join(imageData)),
+                         cls._getChunk(b'IEND', b'')))
+
+    @classmethod
+    def _getChunk(cls, chunkType, data):
+        """
+        Return a PNG chunk: length, type, data and CRC of the type and data
+        """
+        return struct.pack('>I', len(data)) + chunkType + data + struct.pack('>I', zlib.crc32(chunkType + data) & 0xFFFFFFFF)
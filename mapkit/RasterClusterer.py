@@ -0,0 +1,312 @@
+"""
+********************************************************************************
+* Name: RasterClusterer
+* Author: Nathan Swain
+* Created On: October 18, 2026
+* Copyright: (c) Brigham Young University 2013
+* License: BSD 2-Clause
+********************************************************************************
+"""
+import struct
+
+try:
+    import numpy
+    numpy_enabled = True
+except ImportError:
+    numpy_enabled = False
+
+
+class RasterClusterer(object):
+    """
+    Clusters the cells of a raster band into polygons in Python, as an alternative to ST_DumpAsPolygons in the
+    database. Like ST_DumpAsPolygons, cells that share an edge and have the same value form one cluster, no data cells
+    are left out and each cluster is a polygon with holes. Requires NumPy.
+    """
+
+    @classmethod
+    def getClusterPolygons(cls, rasterReader, bandNumber=1):
+        """
+        Return the clusters of a band as (value, polygon) tuples ordered by value, where polygon is the Well Known
+        Binary of the cluster in the spatial reference system of the raster.
+        :param rasterReader: WKBRasterReader of the raster
+        :param bandNumber: Band to cluster (starting at 1)
+        :rtype: list of (float, bytes) tuples
+        """
+        if not numpy_enabled:
+            raise ImportError('RASTER CLUSTER ERROR: NumPy is required to cluster rasters in Python.')
+
+        band = rasterReader.getBand(bandNumber)
+        values = band.getArray()
+
+        valid = numpy.ones(values.shape, dtype=bool)
+
+        if band.noDataValue is not None:
+            valid &= values != band.noDataValue
+
+        if values.dtype.kind == 'f':
+            valid &= ~numpy.isnan(values)
+
+        labels = cls.labelClusters(values, valid)
+
+        # Value of each cluster from its first cell
+        clusterLabels, firstCells = numpy.unique(labels.ravel(), return_index=True)
+        clusterValues = dict(zip(clusterLabels.tolist(), values.ravel()[firstCells].tolist()))
+
+        clusters = []
+
+        for label, rings in cls.traceClusters(labels):
+            exterior, holes = cls._assembleRings(rings)
+            clusters.append((float(clusterValues[label]), cls._getPolygonWKB(rasterReader, [exterior] + holes)))
+
+        # Stable, so clusters with the same value keep the order they were traced in
+        clusters.sort(key=lambda cluster: cluster[0])
+
+        return clusters
+
+    @classmethod
+    def labelClusters(cls, values, valid):
+        """
+        Return an array with the label of the cluster of each cell (-1 for cells that are not valid). Runs of cells
+        with the same value in each row are joined with the touching runs of the row above that have the same value.
+        :param values: height x width array of cell values
+        :param valid: height x width boolean array of the cells to cluster
+        :rtype: numpy.ndarray
+        """
+        height, width = values.shape
+        labels = numpy.full((height, width), -1, dtype=numpy.int64)
+        parents = []
+
+        def find(label):
+            while parents[label] != label:
+                parents[label] = parents[parents[label]]
+                label = parents[label]
+            return label
+
+        previousRuns = []
+
+        for rowIndex in range(height):
+            row = values[rowIndex]
+            rowValid = valid[rowIndex]
+
+            # Boundaries of the runs of cells with the same value
+            changes = numpy.flatnonzero((row[1:] != row[:-1]) | (rowValid[1:] != rowValid[:-1])) + 1
+            starts = [0] + changes.tolist()
+            ends = changes.tolist() + [width]
+
+            runs = []
+            previousIndex = 0
+
+            for start, end in zip(starts, ends):
+                if not rowValid[start]:
+                    continue
+
+                value = row[start]
+                label = len(parents)
+                parents.append(label)
+
+                # Runs of the row above that share an edge with this run
+                while previousIndex < len(previousRuns) and previousRuns[previousIndex][1] <= start:
+                    previousIndex += 1
+
+                index = previousIndex
+                while index < len(previousRuns) and previousRuns[index][0] < end:
+                    previousStart, previousEnd, previousValue, previousLabel = previousRuns[index]
+
+                    if previousValue == value:
+                        root, previousRoot = find(label), find(previousLabel)
+                        if root != previousRoot:
+                            parents[max(root, previousRoot)] = min(root, previousRoot)
+
+                    index += 1
+
+                runs.append((start, end, value, label))
+                labels[rowIndex, start:end] = label
+
+            previousRuns = runs
+
+        if parents:
+            roots = numpy.array([find(label) for label in range(len(parents))], dtype=numpy.int64)
+            clustered = labels >= 0
+            labels[clustered] = roots[labels[clustered]]
+
+        return labels
+
+    @classmethod
+    def traceClusters(cls, labels):
+        """
+        Generator that yields the boundary rings of each cluster as (label, rings), where each ring is a tuple of
+        (columns, rows) lists of the cell corner coordinates of the ring. Boundary edges are directed so the cluster
+        is always on the same side, which makes the outer ring and the holes of a cluster turn opposite ways.
+        Corners where more than two clusters (or no data) meet are kept even on a straight edge, so neighboring
+        clusters have the same vertices along the edges they share and form a valid coverage (as ST_CoverageSimplify
+        requires).
+        :param labels: Result of labelClusters
+        """
+        height, width = labels.shape
+        padded = numpy.full((height + 2, width + 2), -1, dtype=labels.dtype)
+        padded[1:-1, 1:-1] = labels
+        clustered = labels >= 0
+
+        # Number of different labels of the four cells around each corner
+        upperLeft, upperRight = padded[:-1, :-1], padded[:-1, 1:]
+        lowerLeft, lowerRight = padded[1:, :-1], padded[1:, 1:]
+        labelCounts = (1 + (upperRight != upperLeft) +
+                       ((lowerLeft != upperLeft) & (lowerLeft != upperRight)) +
+                       ((lowerRight != upperLeft) & (lowerRight != upperRight) & (lowerRight != lowerLeft)))
+        nodes = labelCounts > 2
+
+        # Edges of each cell that border another cluster: (neighbor labels, start corner offset, end corner offset)
+        sides = ((padded[:-2, 1:-1], (1, 0), (0, 0)),  # Top, right to left
+                 (padded[1:-1, :-2], (0, 0), (0, 1)),  # Left, top to bottom
+                 (padded[2:, 1:-1], (0, 1), (1, 1)),   # Bottom, left to right
+                 (padded[1:-1, 2:], (1, 1), (1, 0)))   # Right, bottom to top
+
+        edgeLabels, startColumns, startRows, endColumns, endRows = [], [], [], [], []
+
+        for neighbors, (startColumn, startRow), (endColumn, endRow) in sides:
+            rows, columns = numpy.nonzero(clustered & (neighbors != labels))
+            edgeLabels.append(labels[rows, columns])
+            startColumns.append(columns + startColumn)
+            startRows.append(rows + startRow)
+            endColumns.append(columns + endColumn)
+            endRows.append(rows + endRow)
+
+        edgeLabels = numpy.concatenate(edgeLabels)
+        order = numpy.argsort(edgeLabels, kind='stable')
+        edgeLabels = edgeLabels[order]
+        startColumns = numpy.concatenate(startColumns)[order]
+        startRows = numpy.concatenate(startRows)[order]
+        endColumns = numpy.concatenate(endColumns)[order]
+        endRows = numpy.concatenate(endRows)[order]
+
+        # Split the edges by cluster
+        bounds = numpy.flatnonzero(numpy.diff(edgeLabels)) + 1
+        firsts = [0] + bounds.tolist()
+        lasts = bounds.tolist() + [len(edgeLabels)]
+
+        for first, last in zip(firsts, lasts):
+            if first == last:
+                continue
+
+            yield int(edgeLabels[first]), cls._linkEdges(startColumns[first:last].tolist(),
+                                                         startRows[first:last].tolist(),
+                                                         endColumns[first:last].tolist(),
+                                                         endRows[first:last].tolist(),
+                                                         nodes)
+
+    @classmethod
+    def _linkEdges(cls, startColumns, startRows, endColumns, endRows, nodes):
+        """
+        Link the directed boundary edges of one cluster into closed rings. Where two cells of the cluster touch at a
+        corner (they are joined by other cells of the cluster), the ring turns away from the cluster, so each ring is
+        simple and the rings only touch at the corner, as in a valid polygon (e.g.: two holes that touch at a corner
+        stay two holes).
+        """
+        outgoing = dict()
+
+        for edge, corner in enumerate(zip(startColumns, startRows)):
+            outgoing.setdefault(corner, []).append(edge)
+
+        used = [False] * len(startColumns)
+        rings = []
+
+        for firstEdge in range(len(startColumns)):
+            if used[firstEdge]:
+                continue
+
+            firstCorner = (startColumns[firstEdge], startRows[firstEdge])
+            columns, rows = [], []
+            edge = firstEdge
+
+            while True:
+                used[edge] = True
+                columns.append(startColumns[edge])
+                rows.append(startRows[edge])
+
+                corner = (endColumns[edge], endRows[edge])
+                candidates = [candidate for candidate in outgoing[corner] if not used[candidate]]
+
+                if corner == firstCorner:
+                    candidates.append(firstEdge)
+
+                if len(candidates) > 1:
+                    # Sharpest turn away from the cluster (cross product of the directions is largest)
+                    directionColumn = endColumns[edge] - startColumns[edge]
+                    directionRow = endRows[edge] - startRows[edge]
+                    candidates.sort(key=lambda candidate: directionColumn * (endRows[candidate] - startRows[candidate]) -
+                                                          directionRow * (endColumns[candidate] - startColumns[candidate]),
+                                    reverse=True)
+
+                edge = candidates[0]
+
+                if edge == firstEdge:
+                    break
+
+            rings.append(cls._removeCollinearCorners(columns, rows, nodes))
+
+        return rings
+
+    @classmethod
+    def _removeCollinearCorners(cls, columns, rows, nodes):
+        """
+        Return the ring without the corners that are on a straight line between their neighbors, except the nodes
+        (corners where more than two clusters meet, see traceClusters)
+        """
+        count = len(columns)
+        keptColumns, keptRows = [], []
+
+        for index in range(count):
+            previous = index - 1
+            following = (index + 1) % count
+
+            if nodes[rows[index], columns[index]] or \
+                    (columns[index] - columns[previous]) * (rows[following] - rows[index]) != \
+                    (rows[index] - rows[previous]) * (columns[following] - columns[index]):
+                keptColumns.append(columns[index])
+                keptRows.append(rows[index])
+
+        return keptColumns, keptRows
+
+    @classmethod
+    def _assembleRings(cls, rings):
+        """
+        Return the rings of a cluster as (exterior, holes). The outer ring has negative area (shoelace formula in cell
+        coordinates) and holes positive. Cells of a cluster share edges, so it has exactly one outer ring.
+        """
+        exteriors = [ring for ring in rings if cls._getSignedArea(ring) < 0]
+        holes = [ring for ring in rings if cls._getSignedArea(ring) > 0]
+
+        if len(exteriors) != 1:
+            raise ValueError('RASTER CLUSTER ERROR: expected one outer ring per cluster, found {0}.'.format(len(exteriors)))
+
+        return exteriors[0], holes
+
+    @classmethod
+    def _getSignedArea(cls, ring):
+        columns, rows = ring
+        area = 0
+
+        for index in range(len(columns)):
+            area += columns[index - 1] * rows[index] - columns[index] * rows[index - 1]
+
+        return area / 2.0
+
+    @classmethod
+    def _getPolygonWKB(cls, rasterReader, rings):
+        """
+        Return the Well Known Binary (little endian) of a polygon given rings in cell corner coordinates
+        """
+        parts = [struct.pack('<BII', 1, 3, len(rings))]
+
+        for columns, rows in rings:
+            # Close the ring
+            columns = numpy.array(columns + columns[:1], dtype=numpy.float64)
+            rows = numpy.array(rows + rows[:1], dtype=numpy.float64)
+
+            x = rasterReader.upperLeftX + columns * rasterReader.scaleX + rows * rasterReader.skewX
+            y = rasterReader.upperLeftY + columns * rasterReader.skewY + rows * rasterReader.scaleY
+
+            parts.append(struct.pack('<I', len(columns)))
+            parts.append(numpy.column_stack((x, y)).astype('<f8').tobytes())
+
+        return b''.join(parts)
@@ -7,16 +7,36 @@
 * License: BSD 2-Clause
 ********************************************************************************
 """
+import itertools
+import logging
+import threading
+import uuid
+import weakref
 import xml.etree.ElementTree as ET
 
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm.session import Session
 
-from mapkit.ColorRampGenerator import ColorRampGenerator, ColorRampEnum
+from mapkit import formatCoordinate
+from mapkit.ColorRampGenerator import ColorRampGenerator, ColorRampEnum, ColorRampMixin
+from mapkit.PngWriter import PngWriter
+from mapkit.RasterClusterer import RasterClusterer
+from mapkit.WKBRasterReader import WKBRasterReader
+from mapkit.SessionManager import SessionManager, sessionPerCall
+from mapkit.sqlautils import prepareStatement, coerceIds, catalogName
 
+try:
+    from osgeo import gdal
+    gdal_enabled = True
+except ImportError:
+    gdal_enabled = False
 
-class RasterConverter(object):
+
+log = logging.getLogger(__name__)
+
+
+class RasterConverter(SessionManager, ColorRampMixin):
     """
     An instance of RasterConverter can be used to extract PostGIS
     rasters from a database and convert them into different formats
@@ -30,27 +50,43 @@ class RasterConverter(object):
     NO_DATA_VALUE_MIN = float(-1.0)
     NO_DATA_VALUE_MAX = float(0.0)
     GDAL_ASCII_DATA_TYPES = ['Int32', 'Float32', 'Float64']
+    RASTER_METADATA_COLUMNS = ('no_data_value', 'min_value', 'max_value', 'footprint')
+    WEB_MERCATOR_RESOLUTION = 156543.03392804097  # Meters per pixel of 256 pixel tiles at zoom level 0
+    KML_PRECISION = 15  # Default decimal places of ST_AsKML
+    GEOJSON_PRECISION = 9  # Default decimal places of ST_AsGeoJSON
+    VALID_RESAMPLE_METHODS = ('NearestNeighbour', 'Bilinear', 'Cubic', 'CubicSpline', 'Lanczos')
+
+    # GDAL drivers supported by the database of each engine (see supportedGdalRasterFormats)
+    _gdalDriverCache = weakref.WeakKeyDictionary()
+    _gdalDriverCacheLock = threading.Lock()
 
-    def __init__(self, sqlAlchemyEngineOrSession, colorRamp=None):
+    def __init__(self, sqlAlchemyEngineOrSession, colorRamp=None, threadSafe=False):
         """
         Constructor
+        :param sqlAlchemyEngineOrSession: SQLAlchemy engine or session bound to a PostGIS enabled database
+        :param colorRamp: List of RGB tuples (defaults to the hue color ramp)
+        :param threadSafe: Check out a session from the engine for each call so the instance can be shared by many threads (requires an engine)
         """
-        # Create sqlalchemy session
-        if isinstance(sqlAlchemyEngineOrSession, Engine):
-            sessionMaker = sessionmaker(bind=sqlAlchemyEngineOrSession)
-            self._session = sessionMaker()
-        elif isinstance(sqlAlchemyEngineOrSession, Session):
-            self._session = sqlAlchemyEngineOrSession
+        super(RasterConverter, self).__init__(sqlAlchemyEngineOrSession, threadSafe=threadSafe)
 
         if not colorRamp:
             self.setDefaultColorRamp(ColorRampEnum.COLOR_RAMP_HUE)
         else:
             self._colorRamp = colorRamp
 
-    def getAsKmlGrid(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster', documentName='default', alpha=1.0, noDataValue=0, discreet=False):
+        # Tables known to have (or not have) the persisted metadata columns, overviews and WGS 84 copies
+        self._metadataTables = dict()
+        self._overviewTables = dict()
+        self._wgs84Tables = dict()
+
+    @sessionPerCall
+    def getAsKmlGrid(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster', documentName='default', alpha=1.0, noDataValue=0, discreet=False,
+                     bbox=None, bboxSrid=4326, precision=None):
         """
         Creates a KML file with each cell in the raster represented by a polygon. The result is a vector grid representation of the raster.
         Note that pixels with values between -1 and 0 are omitted as no data values. Also note that this method only works on the first band.
+        Pass bbox=(minX, minY, maxX, maxY) in the bboxSrid spatial reference system to only convert the cells within the bounding box.
+        Pass precision to limit the number of decimal places of the coordinates (e.g.: 6 or 7 is plenty for WGS 84).
         Returns the kml document as a string.
         """
         # Validate alpha
@@ -71,16 +107,18 @@ class RasterConverter(object):
                                                                   alpha=alpha)
 
         # Get polygons for each cell in kml format
-        statement = '''
-                    SELECT x, y, val, ST_AsKML(geom) AS polygon
+        statement = prepareStatement('''
+                    SELECT x, y, val, ST_AsKML(geom, CAST(:precision AS integer)) AS polygon
                     FROM (
-                    SELECT (ST_PixelAsPolygons(%s)).*
-                    FROM %s WHERE %s=%s
+                    SELECT (ST_PixelAsPolygons(''' + self._clipToBbox('{raster}', bbox) + ''')).*
+                    FROM {table} WHERE {rasterId}=:rasterId''' + self._bboxCondition('{raster}', bbox, self._session, tableName) + '''
                     ) AS foo
                     ORDER BY val;
-                    ''' % (rasterFieldName, tableName, rasterIdFieldName, rasterId)
+                    ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
 
-        result = self._session.execute(statement)
+        result = self._session.execute(statement, dict(self._getBboxParameters(bbox, bboxSrid),
+                                                       rasterId=rasterId,
+                                                       precision=self._getPrecision(precision, self.KML_PRECISION)))
 
         # Initialize KML Document
         kml = ET.Element('kml', xmlns='http://www.opengis.net/kml/2.2')
@@ -89,7 +127,6 @@ class RasterConverter(object):
         docName.text = documentName
 
         groupValue = -9999999.0
-        uniqueValues = []
 
         # Add polygons to the kml file with styling
         for row in result:
@@ -105,10 +142,6 @@ class RasterConverter(object):
 
             # Only create placemarks for values that are no data values
             if value:
-                # Collect unique values
-                if value not in uniqueValues:
-                    uniqueValues.append(value)
-
                 # Create a new placemark for each group of values
                 if value != groupValue:
                     placemark = ET.SubElement(document, 'Placemark')
@@ -173,19 +206,36 @@ class RasterConverter(object):
             # Embed the color ramp in SLD format
             document.append(ET.fromstring(mappedColorRamp.getColorMapAsContinuousSLD()))
         else:
-            # Sort the unique values
-            uniqueValues.sort()
+            # Determine values for discreet color ramp
+            valueCounts = self.getValueCountsOfRasters(session=self._session,
+                                                       table=tableName,
+                                                       rasterIds=(str(rasterId), ),
+                                                       rasterField=rasterFieldName,
+                                                       rasterIdField=rasterIdFieldName,
+                                                       bbox=bbox,
+                                                       bboxSrid=bboxSrid)
+            uniqueValues = [value for value, count in valueCounts]
             document.append(ET.fromstring(mappedColorRamp.getColorMapAsDiscreetSLD(uniqueValues)))
 
         return ET.tostring(kml)
 
-    def getAsKmlClusters(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster', documentName='default', alpha=1.0,  noDataValue=0, discreet=False):
+    @sessionPerCall
+    def getAsKmlClusters(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster', documentName='default', alpha=1.0,  noDataValue=0, discreet=False,
+                         bbox=None, bboxSrid=4326, tolerance=None, zoom=None, precision=None, engine='database'):
         """
         Creates a KML file where adjacent cells with the same value are clustered together into a polygons. The result is a vector representation
         of each cluster. Note that pixels with values between -1 and 0 are omitted as no data values. Also note that this method only works on the first band.
+        Pass bbox=(minX, minY, maxX, maxY) in the bboxSrid spatial reference system to only convert the cells within the bounding box.
+        Pass a tolerance (in units of the raster spatial reference system) or the web map zoom level the clusters will be viewed at to
+        simplify the cluster polygons (see _simplifyGeometry).
+        Pass precision to limit the number of decimal places of the coordinates (e.g.: 6 or 7 is plenty for WGS 84).
+        Pass engine='numpy' to cluster the cells in Python (see RasterClusterer) instead of with ST_DumpAsPolygons in the database.
         Returns the kml document as a string.
         """
 
+        if engine not in ('database', 'numpy'):
+            raise ValueError("RASTER CONVERSION ERROR: engine must be 'database' or 'numpy'.")
+
         if not (alpha >= 0 and alpha <= 1.0):
             raise ValueError("RASTER CONVERSION ERROR: alpha must be between 0.0 and 1.0.")
 
@@ -202,17 +252,24 @@ class RasterConverter(object):
                                                                   maxValue=maxValue,
                                                                   alpha=alpha)
 
-        # Get a set of polygons representing cluster of adjacent cells with the same value
-        statement = '''
-                    SELECT val, ST_AsKML(geom) As polygon
-                    FROM (
-                    SELECT (ST_DumpAsPolygons(%s)).*
-                    FROM %s WHERE %s=%s
-                    ) As foo
-                    ORDER BY val;
-                    ''' % (rasterFieldName, tableName, rasterIdFieldName, rasterId)
+        if engine == 'numpy':
+            result = self._getClustersInPython(tableName, rasterId, rasterIdFieldName, rasterFieldName, bbox, bboxSrid,
+                                               tolerance, zoom, precision)
+        else:
+            # Get a set of polygons representing cluster of adjacent cells with the same value
+            statement = prepareStatement('''
+                        SELECT val, ST_AsKML(''' + self._simplifyGeometry('geom', tolerance, zoom) + ''', CAST(:precision AS integer)) As polygon
+                        FROM (
+                        SELECT (ST_DumpAsPolygons(''' + self._clipToBbox('{raster}', bbox) + ''')).*
+                        FROM {table} WHERE {rasterId}=:rasterId''' + self._bboxCondition('{raster}', bbox, self._session, tableName) + '''
+                        ) As foo
+                        ORDER BY val;
+                        ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
 
-        result = self._session.execute(statement)
+            result = self._session.execute(statement, dict(self._getBboxParameters(bbox, bboxSrid),
+                                                           rasterId=rasterId,
+                                                           precision=self._getPrecision(precision, self.KML_PRECISION),
+                                                           **self._getSimplifyParameters(tolerance, zoom)))
 
         # Initialize KML Document
         kml = ET.Element('kml', xmlns='http://www.opengis.net/kml/2.2')
@@ -221,7 +278,6 @@ class RasterConverter(object):
         docName.text = documentName
 
         groupValue = -9999999.0
-        uniqueValues = []
 
         # Add polygons to the kml file with styling
         for row in result:
@@ -234,10 +290,6 @@ class RasterConverter(object):
             polygonString = row.polygon
 
             if value:
-                # Collect unique values
-                if value not in uniqueValues:
-                    uniqueValues.append(value)
-
                 # Create a new placemark for each group of values
                 if value != groupValue:
                     placemark = ET.SubElement(document, 'Placemark')
@@ -295,21 +347,81 @@ class RasterConverter(object):
             # Embed the color ramp in SLD format
             document.append(ET.fromstring(mappedColorRamp.getColorMapAsContinuousSLD()))
         else:
-            # Sort the unique values
-            uniqueValues.sort()
+            # Determine values for discreet color ramp
+            valueCounts = self.getValueCountsOfRasters(session=self._session,
+                                                       table=tableName,
+                                                       rasterIds=(str(rasterId), ),
+                                                       rasterField=rasterFieldName,
+                                                       rasterIdField=rasterIdFieldName,
+                                                       bbox=bbox,
+                                                       bboxSrid=bboxSrid)
+            uniqueValues = [value for value, count in valueCounts]
             document.append(ET.fromstring(mappedColorRamp.getColorMapAsDiscreetSLD(uniqueValues)))
 
         return ET.tostring(kml)
 
-    def getAsKmlPng(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster', documentName='default',
-                    alpha=1.0,  drawOrder=0, noDataValue=0, cellSize=None, resampleMethod='NearestNeighbour', discreet=False):
+    def _getClustersInPython(self, tableName, rasterId, rasterIdFieldName, rasterFieldName, bbox, bboxSrid, tolerance,
+                             zoom, precision):
         """
-        Creates a KML wrapper and PNG represent of the raster. Returns a string of the kml file contents and
-        a binary string of the PNG contents. The color ramp used to generate the PNG is embedded in the ExtendedData
-        tag of the GroundOverlay.
-        IMPORTANT: The PNG image is referenced in the kml as 'raster.png', thus it must be written to file with that
-        name for the kml to recognize it.
+        Return the clusters of band 1 of the raster as rows of val and polygon (KML) ordered by value, like the
+        ST_DumpAsPolygons query of getAsKmlClusters. The cells are clustered by RasterClusterer; the database only
+        transforms and serializes the polygons.
         """
+        statement = prepareStatement('''
+                    SELECT ST_AsBinary(''' + self._clipToBbox('{raster}', bbox) + ''') AS wkb
+                    FROM {table} WHERE {rasterId}=:rasterId''' + self._bboxCondition('{raster}', bbox, self._session, tableName) + ''';
+                    ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
+
+        wellKnownBinary = self._session.execute(statement, dict(self._getBboxParameters(bbox, bboxSrid),
+                                                                rasterId=rasterId)).scalar()
+
+        if wellKnownBinary is None:
+            return []
+
+        rasterReader = WKBRasterReader(wellKnownBinary)
+        clusters = RasterClusterer.getClusterPolygons(rasterReader)
+
+        if not clusters:
+            return []
+
+        statement = prepareStatement('''
+                    SELECT c.val, ST_AsKML(''' + self._simplifyGeometry('ST_SetSRID(ST_GeomFromWKB(c.wkb), CAST(:srid AS integer))', tolerance, zoom) + ''', CAST(:precision AS integer)) AS polygon
+                    FROM unnest(CAST(:wkbs AS bytea[]), CAST(:vals AS double precision[])) WITH ORDINALITY AS c(wkb, val, n)
+                    ORDER BY c.n;
+                    ''')
+
+        return self._session.execute(statement, dict(self._getSimplifyParameters(tolerance, zoom),
+                                                     srid=rasterReader.srid,
+                                                     wkbs=[polygon for value, polygon in clusters],
+                                                     vals=[value for value, polygon in clusters],
+                                                     precision=self._getPrecision(precision, self.KML_PRECISION)))
+
+    @sessionPerCall
+    def getAsMvtClusters(self, tableName, z, x, y, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster',
+                         layerName='clusters', alpha=1.0, noDataValue=0, extent=4096, buffer=64):
+        """
+        Return the clusters of getAsKmlClusters that fall within one web mercator tile as a Mapbox Vector Tile. The
+        raster is clipped to the tile before adjacent cells with the same value are clustered. Each feature has the
+        attributes value and color (the color of the value on the color ramp as a '#RRGGBB' string). Clusters with
+        the value 0 are left out, as they are in the KML output. Requires PostGIS 3.0 or later.
+
+        :param tableName: Name of the table to extract the raster from
+        :param z: Zoom level of the tile
+        :param x: Column of the tile
+        :param y: Row of the tile
+        :param rasterId: Id of the raster to convert
+        :param rasterIdFieldName: Name of the id field for rasters (usually the primary key field)
+        :param rasterFieldName: Name of the field where rasters are stored (of type raster)
+        :param layerName: Name of the layer in the tile
+        :param alpha: The transparency of the color ramp
+        :param noDataValue: The value to be used as the no data value (default is 0)
+        :param extent: Size of the tile in tile coordinate units
+        :param buffer: Distance in tile coordinate units the geometries may extend beyond the tile
+
+        :rtype : bytes
+        """
+        if not (alpha >= 0 and alpha <= 1.0):
+            raise ValueError("RASTER CONVERSION ERROR: alpha must be between 0.0 and 1.0.")
 
         # Get the color ramp and parameters
         minValue, maxValue = self.getMinMaxOfRasters(session=self._session,
@@ -324,47 +436,222 @@ class RasterConverter(object):
                                                                   maxValue=maxValue,
                                                                   alpha=alpha)
 
-        # Join strings in list to create ramp
-        rampString = mappedColorRamp.getPostGisColorRampString()
+        # Cluster the part of the raster in the tile
+        statement = prepareStatement('''
+                    WITH bounds AS (
+                        SELECT ST_TileEnvelope(CAST(:z AS integer), CAST(:x AS integer), CAST(:y AS integer)) AS geom
+                    ),
+                    clusters AS (
+                        SELECT (ST_DumpAsPolygons(ST_Clip(t.{raster}, ST_Transform(bounds.geom, ST_SRID(t.{raster}))))).*
+                        FROM {table} AS t, bounds
+                        WHERE t.{rasterId}=:rasterId
+                        AND ST_Intersects(t.{raster}, ST_Transform(bounds.geom, ST_SRID(t.{raster})))
+                    ),
+                    features AS (
+                        SELECT clusters.val AS value, ''' + self._getColorExpression('clusters.val') + ''' AS color,
+                               ST_AsMVTGeom(ST_Transform(clusters.geom, 3857), bounds.geom,
+                                            CAST(:extent AS integer), CAST(:buffer AS integer), true) AS geom
+                        FROM clusters, bounds
+                        WHERE clusters.val <> 0
+                    )
+                    SELECT ST_AsMVT(features, CAST(:layerName AS text), CAST(:extent AS integer), 'geom') AS tile
+                    FROM features
+                    WHERE geom IS NOT NULL;
+                    ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
+
+        tile = self._session.execute(statement, dict(self._getColorParameters(mappedColorRamp),
+                                                     z=z,
+                                                     x=x,
+                                                     y=y,
+                                                     rasterId=rasterId,
+                                                     layerName=layerName,
+                                                     extent=extent,
+                                                     buffer=buffer)).scalar()
+
+        # An empty tile when the raster is not in the tile
+        return bytes(tile) if tile is not None else bytes()
+
+    def iterGeoJsonGrid(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster', noDataValue=0,
+                        precision=None, bbox=None, bboxSrid=4326):
+        """
+        Generator that yields the cells of getAsKmlGrid as newline-delimited GeoJSON (one Feature per line, in
+        WGS 84). The rows are streamed from the database, so memory use does not grow with the size of the raster
+        and the lines can be written to a file (e.g.: fileObject.writelines(...)) or sent as a chunked response.
+        Each feature has the properties value, color ('#RRGGBB'), i and j. Cells with the value 0 are left out, as
+        they are in the KML output.
+
+        :param precision: Number of decimal places of the coordinates (defaults to the PostGIS default of 9)
+        :param bbox: Bounding box (minX, minY, maxX, maxY) to limit the conversion to (default is the whole raster)
+        :param bboxSrid: Spatial reference ID of the bounding box coordinates (default is 4326)
+        """
+        return self._iterGeoJsonFeatures('ST_PixelAsPolygons', tableName, rasterId, rasterIdFieldName, rasterFieldName,
+                                         noDataValue, precision, bbox, bboxSrid)
 
-        # Get a PNG representation of the raster
-        result = self.getRastersAsPngs(session=self._session,
-                                       tableName=tableName,
-                                       rasterIds=(str(rasterId),),
-                                       postGisRampString=rampString,
-                                       rasterField=rasterFieldName,
-                                       rasterIdField=rasterIdFieldName,
-                                       cellSize=cellSize,
-                                       resampleMethod=resampleMethod)
+    def iterGeoJsonClusters(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster', noDataValue=0,
+                            precision=None, bbox=None, bboxSrid=4326, tolerance=None, zoom=None):
+        """
+        Generator that yields the clusters of getAsKmlClusters as newline-delimited GeoJSON (one Feature per line, in
+        WGS 84). Streams like iterGeoJsonGrid. Each feature has the properties value and color ('#RRGGBB'). Clusters
+        with the value 0 are left out, as they are in the KML output.
+
+        :param precision: Number of decimal places of the coordinates (defaults to the PostGIS default of 9)
+        :param bbox: Bounding box (minX, minY, maxX, maxY) to limit the conversion to (default is the whole raster)
+        :param bboxSrid: Spatial reference ID of the bounding box coordinates (default is 4326)
+        :param tolerance: Simplify the cluster polygons with this tolerance in units of the raster spatial reference system
+        :param zoom: Simplify the cluster polygons for viewing at this web map zoom level (alternative to tolerance)
+        The clusters are simplified together (see _simplifyGeometry), so with a tolerance or zoom the first feature is
+        only yielded once all clusters have been read.
+        """
+        return self._iterGeoJsonFeatures('ST_DumpAsPolygons', tableName, rasterId, rasterIdFieldName, rasterFieldName,
+                                         noDataValue, precision, bbox, bboxSrid, tolerance, zoom)
 
-        for row in result:
-            binaryPNG = row.png
+    def _iterGeoJsonFeatures(self, polygonizeFunction, tableName, rasterId, rasterIdFieldName, rasterFieldName,
+                             noDataValue, precision, bbox, bboxSrid, tolerance=None, zoom=None):
+        """
+        Generator for iterGeoJsonGrid and iterGeoJsonClusters. The session scope stays open until the generator is
+        exhausted or closed.
+        """
+        if polygonizeFunction == 'ST_PixelAsPolygons':
+            properties = "'value', val, 'color', " + self._getColorExpression('val') + ", 'i', x, 'j', y"
+        else:
+            properties = "'value', val, 'color', " + self._getColorExpression('val')
 
-        # Determine extents for the KML wrapper file via query
-        statement = '''
-                    SELECT (foo.metadata).*
+        statement = prepareStatement('''
+                    SELECT CAST(json_build_object(
+                               'type', 'Feature',
+                               'geometry', CAST(ST_AsGeoJSON(ST_Transform(''' + self._simplifyGeometry('geom', tolerance, zoom) + ''', 4326), CAST(:precision AS integer)) AS json),
+                               'properties', json_build_object(''' + properties + ''')) AS text) AS feature
                     FROM (
-                    SELECT ST_MetaData(ST_Transform({0}, 4326, 'Bilinear')) as metadata
-                    FROM {1}
-                    WHERE {2}={3}
-                    ) As foo;
-                    '''.format(rasterFieldName, tableName, rasterIdFieldName, rasterId)
+                    SELECT (''' + polygonizeFunction + '''(''' + self._clipToBbox('{raster}', bbox) + ''')).*
+                    FROM {table} WHERE {rasterId}=:rasterId''' + self._bboxCondition('{raster}', bbox, self._session, tableName) + '''
+                    ) AS foo
+                    WHERE val IS NOT NULL AND val <> 0;
+                    ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
+
+        with self.sessionScope():
+            minValue, maxValue = self.getMinMaxOfRasters(session=self._session,
+                                                         table=tableName,
+                                                         rasterIds=(str(rasterId), ),
+                                                         rasterIdField=rasterIdFieldName,
+                                                         rasterField=rasterFieldName,
+                                                         noDataValue=noDataValue)
+
+            mappedColorRamp = ColorRampGenerator.mapColorRampToValues(colorRamp=self._colorRamp,
+                                                                      minValue=minValue,
+                                                                      maxValue=maxValue)
+
+            parameters = dict(self._getColorParameters(mappedColorRamp),
+                              rasterId=rasterId,
+                              precision=self._getPrecision(precision, self.GEOJSON_PRECISION))
+            parameters.update(self._getBboxParameters(bbox, bboxSrid))
+            parameters.update(self._getSimplifyParameters(tolerance, zoom))
+
+            # Server side cursor, so the features are fetched in batches as they are consumed
+            result = self._session.execute(statement.execution_options(stream_results=True), parameters)
+
+            try:
+                for row in result:
+                    yield row.feature + '\n'
+            finally:
+                result.close()
+
+    @sessionPerCall
+    def getAsKmlPng(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster', documentName='default',
+                    alpha=1.0,  drawOrder=0, noDataValue=0, cellSize=None, resampleMethod='NearestNeighbour', discreet=False,
+                    maxPixels=None, maxSize=None, bbox=None, bboxSrid=4326, precision=None, singleQuery=False,
+                    palette=False, warpMethod=None, wgs84Copy=False):
+        """
+        Creates a KML wrapper and PNG represent of the raster. Returns a string of the kml file contents and
+        a binary string of the PNG contents. The color ramp used to generate the PNG is embedded in the ExtendedData
+        tag of the GroundOverlay.
+        IMPORTANT: The PNG image is referenced in the kml as 'raster.png', thus it must be written to file with that
+        name for the kml to recognize it.
+        Use maxPixels or maxSize=(maxWidth, maxHeight) to bound the size of the PNG instead of choosing a cellSize.
+        Pass bbox=(minX, minY, maxX, maxY) in the bboxSrid spatial reference system to only render the part of the
+        raster within the bounding box. Pass precision to limit the number of decimal places of the coordinates.
+        Pass singleQuery=True to compute the statistics, PNG, extent and (if discreet) legend values in one statement
+        (see _getKmlPngInOneQuery). Pass palette=True to return an 8-bit palette PNG with the colors of the color ramp
+        instead of an RGBA PNG (see getPalettePng). Pass warpMethod to warp the values to WGS 84 before they are
+        colored, or wgs84Copy=True to render the copies made by buildWgs84Copies without warping
+        (see getRastersAsPngs). The copies go stale when the rasters change, until they are built again.
+        """
+        if singleQuery and palette:
+            raise ValueError('RASTER CONVERSION ERROR: singleQuery cannot be combined with palette.')
 
-        result = self._session.execute(statement)
+        if singleQuery:
+            row = self._getKmlPngInOneQuery(tableName, rasterId, rasterIdFieldName, rasterFieldName, alpha, noDataValue,
+                                            cellSize, resampleMethod, discreet, maxPixels, maxSize, bbox, bboxSrid,
+                                            warpMethod, wgs84Copy)
 
-        for row in result:
-            upperLeftY = row.upperlefty
-            scaleY = row.scaley
-            height = row.height
+            if row is None:
+                raise ValueError('RASTER CONVERSION ERROR: raster {0} could not be found or does not intersect the '
+                                 'bounding box.'.format(rasterId))
 
-            upperLeftX = row.upperleftx
-            scaleX = row.scalex
-            width = row.width
+            minValue, maxValue = row.min_value, row.max_value
+        else:
+            # Get the color ramp and parameters
+            minValue, maxValue = self.getMinMaxOfRasters(session=self._session,
+                                                         table=tableName,
+                                                         rasterIds=(str(rasterId), ),
+                                                         rasterIdField=rasterIdFieldName,
+                                                         rasterField=rasterFieldName,
+                                                         noDataValue=noDataValue)
 
-        north = upperLeftY
-        south = upperLeftY + (scaleY * height)
-        east = upperLeftX + (scaleX * width)
-        west = upperLeftX
+        mappedColorRamp = ColorRampGenerator.mapColorRampToValues(colorRamp=self._colorRamp,
+                                                                  minValue=minValue,
+                                                                  maxValue=maxValue,
+                                                                  alpha=alpha)
+
+        if singleQuery:
+            binaryPNG = row.png
+
+            # The extent of the rendered PNG
+            north, south, east, west = row.north, row.south, row.east, row.west
+            uniqueValues = row.vals or []
+        else:
+            # Join strings in list to create ramp
+            rampString = mappedColorRamp.getPostGisColorRampString()
+
+            # Get a PNG representation of the raster
+            result = self.getRastersAsPngs(session=self._session,
+                                           tableName=tableName,
+                                           rasterIds=(str(rasterId),),
+                                           postGisRampString=rampString,
+                                           rasterField=rasterFieldName,
+                                           rasterIdField=rasterIdFieldName,
+                                           cellSize=cellSize,
+                                           resampleMethod=resampleMethod,
+                                           maxPixels=maxPixels,
+                                           maxSize=maxSize,
+                                           bbox=bbox,
+                                           bboxSrid=bboxSrid,
+                                           palette=palette,
+                                           mappedColorRamp=mappedColorRamp,
+                                           warpMethod=warpMethod,
+                                           wgs84Copy=wgs84Copy)
+
+            row = result.first()
+
+            if row is None:
+                raise ValueError('RASTER CONVERSION ERROR: raster {0} could not be found or does not intersect the '
+                                 'bounding box.'.format(rasterId))
+
+            if palette:
+                binaryPNG = self.getPalettePng(row.indexed, mappedColorRamp)
+            else:
+                binaryPNG = row.png
+
+            # Determine extents for the KML wrapper file
+            if bbox is not None:
+                # The extent of the clipped PNG
+                north, south, east, west = row.north, row.south, row.east, row.west
+            else:
+                north, south, east, west = self.getWgs84ExtentOfRaster(session=self._session,
+                                                                       table=tableName,
+                                                                       rasterId=rasterId,
+                                                                       rasterField=rasterFieldName,
+                                                                       rasterIdField=rasterIdFieldName)
+            uniqueValues = None
 
         # Initialize KML Document
         kml = ET.Element('kml', xmlns='http://www.opengis.net/kml/2.2')
@@ -387,16 +674,16 @@ class RasterConverter(object):
         latLonBox = ET.SubElement(regionElement, 'LatLonBox')
 
         northElement = ET.SubElement(latLonBox, 'north')
-        northElement.text = str(north)
+        northElement.text = formatCoordinate(north, precision)
 
         southElement = ET.SubElement(latLonBox, 'south')
-        southElement.text = str(south)
+        southElement.text = formatCoordinate(south, precision)
 
         eastElement = ET.SubElement(latLonBox, 'east')
-        eastElement.text = str(east)
+        eastElement.text = formatCoordinate(east, precision)
 
         westElement = ET.SubElement(latLonBox, 'west')
-        westElement.text = str(west)
+        westElement.text = formatCoordinate(west, precision)
 
 
         # Href to PNG
@@ -408,46 +695,135 @@ class RasterConverter(object):
         latLonBox = ET.SubElement(groundOverlay, 'LatLonBox')
 
         northElement = ET.SubElement(latLonBox, 'north')
-        northElement.text = str(north)
+        northElement.text = formatCoordinate(north, precision)
 
         southElement = ET.SubElement(latLonBox, 'south')
-        southElement.text = str(south)
+        southElement.text = formatCoordinate(south, precision)
 
         eastElement = ET.SubElement(latLonBox, 'east')
-        eastElement.text = str(east)
+        eastElement.text = formatCoordinate(east, precision)
 
         westElement = ET.SubElement(latLonBox, 'west')
-        westElement.text = str(west)
+        westElement.text = formatCoordinate(west, precision)
 
         if not discreet:
             # Embed the color ramp in SLD format
             document.append(ET.fromstring(mappedColorRamp.getColorMapAsContinuousSLD()))
         else:
-            # Determine values for discreet color ramp
-            statement = '''
-                        SELECT (pvc).*
-                        FROM (
-                              SELECT ST_ValueCount({0}) as pvc
-                              FROM {1}
-                              WHERE {2}={3}
-                             ) As foo
-                        ORDER BY (pvc).value;
-                        '''.format(rasterFieldName, tableName, rasterIdFieldName, rasterId)
-
-            result = self._session.execute(statement)
+            if uniqueValues is None:
+                # Determine values for discreet color ramp
+                valueCounts = self.getValueCountsOfRasters(session=self._session,
+                                                           table=tableName,
+                                                           rasterIds=(str(rasterId), ),
+                                                           rasterField=rasterFieldName,
+                                                           rasterIdField=rasterIdFieldName,
+                                                           bbox=bbox,
+                                                           bboxSrid=bboxSrid)
+                uniqueValues = [value for value, count in valueCounts]
 
-            values = []
-            for row in result:
-                values.append(row.value)
-
-            document.append(ET.fromstring(mappedColorRamp.getColorMapAsDiscreetSLD(values)))
+            document.append(ET.fromstring(mappedColorRamp.getColorMapAsDiscreetSLD(uniqueValues)))
 
         return ET.tostring(kml), binaryPNG
 
-
-
+    def _getKmlPngInOneQuery(self, tableName, rasterId, rasterIdFieldName, rasterFieldName, alpha, noDataValue,
+                             cellSize, resampleMethod, discreet, maxPixels, maxSize, bbox, bboxSrid, warpMethod=None,
+                             wgs84Copy=False):
+        """
+        Return one row with the min_value and max_value of the raster, the png, its north, south, east and west bounds
+        and, when discreet, the legend values (vals) computed in one statement. The raster is read once; the no data
+        value is applied for the statement only instead of being written back to the table, the persisted
+        statistics are used when they were computed with the same no data value, and the PostGIS color map is
+        built in the statement from the statistics the same way as MappedColorRamp.
+        """
+        joins, rasterExpression, parameters = self._getPngRenderParts(self._session, tableName, cellSize,
+                                                                      resampleMethod, maxPixels, maxSize, bbox,
+                                                                      bboxSrid, wgs84Copy, (rasterId, ),
+                                                                      overrideNoData=True)
+        renderExpression = self._getColorMapExpression(rasterExpression, 'ramp.ramp_string', warpMethod, wgs84Copy)
+        parameters.update(self._getWarpParameters(warpMethod))
+
+        if self.hasRasterMetadata(self._session, tableName):
+            metadataColumns = ', no_data_value, min_value, max_value'
+            statistics = '''
+                    SELECT CASE WHEN t.no_data_value = :noDataValue THEN t.min_value ELSE ss.min END AS min,
+                           CASE WHEN t.no_data_value = :noDataValue THEN t.max_value ELSE ss.max END AS max
+                    FROM t
+                    LEFT JOIN LATERAL (
+                        SELECT summary.*
+                        FROM ST_SummaryStats(t.{raster}, 1, true) AS summary
+                        WHERE t.no_data_value IS DISTINCT FROM :noDataValue
+                    ) AS ss ON true'''
+        else:
+            metadataColumns = ''
+            statistics = '''
+                    SELECT summary.*
+                    FROM t CROSS JOIN LATERAL ST_SummaryStats(t.{raster}, 1, true) AS summary'''
+
+        if discreet:
+            values = ''',
+                           (SELECT array_agg(v.value ORDER BY v.value)
+                            FROM t CROSS JOIN LATERAL ST_ValueCount(''' + self._clipToBbox('t.{raster}', bbox) + ''', 1, true) AS v) AS vals'''
+        else:
+            values = ''',
+                           NULL AS vals'''
+
+        # OFFSET 0 keeps the rendered raster from being computed once per output column
+        statement = prepareStatement('''
+                    WITH t AS (
+                    SELECT {rasterId}, ST_SetBandNoDataValue({raster}, 1, CAST(:noDataValue AS double precision)) AS {raster}''' + metadataColumns + '''
+                    FROM {table}
+                    WHERE {rasterId}=:rasterId
+                    ),
+                    stats AS (
+                    SELECT COALESCE(s.min, 0) AS min_value, COALESCE(s.max, 1) AS max_value
+                    FROM (''' + statistics + '''
+                    ) AS s
+                    ),
+                    ramp AS (
+                    SELECT CASE WHEN stats.min_value <> stats.max_value
+                                THEN string_agg(concat_ws(' ', stats.max_value - (c.n - c.i) * (stats.max_value - stats.min_value) / (c.n - 1),
+                                                          c.red, c.green, c.blue, CAST(:alpha AS integer)), chr(10) ORDER BY c.i DESC)
+                                ELSE concat_ws(' ', stats.max_value, (CAST(:reds AS integer[]))[1], (CAST(:greens AS integer[]))[1],
+                                               (CAST(:blues AS integer[]))[1], CAST(:alpha AS integer))
+                           END || chr(10) || 'nv 0 0 0 0' AS ramp_string
+                    FROM stats
+                    CROSS JOIN LATERAL (
+                        SELECT r.red, r.green, r.blue, r.i, cardinality(CAST(:reds AS integer[])) AS n
+                        FROM unnest(CAST(:reds AS integer[]), CAST(:greens AS integer[]), CAST(:blues AS integer[]))
+                             WITH ORDINALITY AS r(red, green, blue, i)
+                    ) AS c
+                    GROUP BY stats.min_value, stats.max_value
+                    )
+                    SELECT ST_AsPNG(rendered) As png, min_value, max_value,
+                           ST_UpperLeftY(rendered) AS north,
+                           ST_UpperLeftY(rendered) + ST_ScaleY(rendered) * ST_Height(rendered) AS south,
+                           ST_UpperLeftX(rendered) + ST_ScaleX(rendered) * ST_Width(rendered) AS east,
+                           ST_UpperLeftX(rendered) AS west''' + values + '''
+                    FROM (
+                    SELECT ''' + renderExpression + ''' As rendered,
+                           stats.min_value, stats.max_value
+                    FROM t CROSS JOIN stats CROSS JOIN ramp''' + joins + '''
+                    WHERE true''' + self._bboxCondition('t.{raster}', bbox) + '''
+                    OFFSET 0
+                    ) AS foo;
+                    ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName,
+                                     overviews=self.getOverviewTableName(tableName),
+                                     wgs84=self.getWgs84TableName(tableName))
+
+        return self._session.execute(statement, dict(parameters,
+                                                     rasterId=rasterId,
+                                                     noDataValue=float(noDataValue),
+                                                     alpha=int(alpha * 255),
+                                                     reds=[int(rgb[0]) for rgb in self._colorRamp],
+                                                     greens=[int(rgb[1]) for rgb in self._colorRamp],
+                                                     blues=[int(rgb[2]) for rgb in self._colorRamp])).first()
+
+
+
+    @sessionPerCall
     def getAsKmlGridAnimation(self, tableName, timeStampedRasters=[], rasterIdFieldName='id', rasterFieldName='raster',
-                              documentName='default', alpha=1.0,  noDataValue=0, discreet=False):
+                              documentName='default', alpha=1.0,  noDataValue=0, discreet=False, bbox=None, bboxSrid=4326,
+                              deltaEncoding=False, precision=None):
         """
         Return a sequence of rasters with timestamps as a kml with time markers for animation.
 
@@ -466,6 +842,12 @@ class RasterConverter(object):
         :param documentName: The name to give to the KML document (will be listed in legend under this name)
         :param alpha: The transparency to apply to each raster cell
         :param noDataValue: The value to be used as the no data value (default is 0)
+        :param bbox: Bounding box (minX, minY, maxX, maxY) to limit the conversion to (default is the whole raster)
+        :param bboxSrid: Spatial reference ID of the bounding box coordinates (default is 4326)
+        :param deltaEncoding: Only add a placemark for a cell when its value changes, with a TimeSpan covering the
+                              frames the value held (default is a placemark for every cell of every frame). All of
+                              the rasters must be on the same grid (origin, scale, size and SRID).
+        :param precision: Number of decimal places of the coordinates (default is full precision)
 
         :rtype : string
         """
@@ -501,15 +883,8 @@ class RasterConverter(object):
 
 
 
-        # Default to time delta to None
-        deltaTime = None
-
-        # Calculate delta time between images if more than one
-        time1 = timeStampedRasters[0]['dateTime']
-
-        if len(timeStampedRasters) >= 2:
-            time2 = timeStampedRasters[1]['dateTime']
-            deltaTime = time2 - time1
+        # Time span of each frame (None if there is only one frame)
+        timeSpans = self.getTimeSpans(timeStampedRasters)
 
         # Initialize KML Document
         kml = ET.Element('kml', xmlns='http://www.opengis.net/kml/2.2')
@@ -521,8 +896,16 @@ class RasterConverter(object):
             # Embed the color ramp in SLD format
             document.append(ET.fromstring(mappedColorRamp.getColorMapAsContinuousSLD()))
         else:
-            values = []
-            document.append(ET.fromstring(mappedColorRamp.getColorMapAsDiscreetSLD(values)))
+            # Determine values for discreet color ramp from all of the frames
+            valueCounts = self.getValueCountsOfRasters(session=self._session,
+                                                       table=tableName,
+                                                       rasterIds=rasterIds,
+                                                       rasterField=rasterFieldName,
+                                                       rasterIdField=rasterIdFieldName,
+                                                       bbox=bbox,
+                                                       bboxSrid=bboxSrid)
+            uniqueValues = [value for value, count in valueCounts]
+            document.append(ET.fromstring(mappedColorRamp.getColorMapAsDiscreetSLD(uniqueValues)))
 
         # Apply special style to hide legend items
         style = ET.SubElement(document, 'Style', id='check-hide-children')
@@ -532,140 +915,263 @@ class RasterConverter(object):
         styleUrl = ET.SubElement(document, 'styleUrl')
         styleUrl.text = '#check-hide-children'
 
-        # Collect unique values
-        uniqueValues = []
+        # Polygonize once when all of the frames share the same grid, otherwise polygonize each frame
+        if self._haveSameGrid(self._session, tableName, rasterIds, rasterFieldName, rasterIdFieldName):
+            frames = self._iterSharedGridCells(tableName, rasterIds, rasterFieldName, rasterIdFieldName, bbox, bboxSrid,
+                                               precision)
+        elif deltaEncoding:
+            # Delta runs are keyed on the cell (i, j), which is only the same place in every frame on a shared grid
+            raise ValueError('RASTER CONVERSION ERROR: deltaEncoding requires rasters on the same grid.')
+        else:
+            frames = self._iterGridCells(tableName, rasterIds, rasterFieldName, rasterIdFieldName, bbox, bboxSrid, precision)
 
         # Retrieve the rasters and styles
-        for timeStampedRaster in timeStampedRasters:
-            # Extract variables
-            rasterId = timeStampedRaster['rasterId']
+        if deltaEncoding:
+            self._addDeltaGridPlacemarks(document, mappedColorRamp, frames, timeSpans)
+        else:
+            for index, cells in enumerate(frames):
+                timeSpan = timeSpans[index] if timeSpans else None
 
-            if deltaTime:
-                dateTime = timeStampedRaster['dateTime']
-                prevDateTime = dateTime - deltaTime
+                # Set initial group value
+                groupValue = -9999999.0
 
-            # Get polygons for each cell in kml format
-            statement = '''
-                        SELECT x, y, val, ST_AsKML(geom) AS polygon
-                        FROM (
-                        SELECT (ST_PixelAsPolygons({0})).*
-                        FROM {1} WHERE {2}={3}
-                        ) AS foo
-                        ORDER BY val;
-                        '''.format(rasterFieldName, tableName, rasterIdFieldName, rasterId)
+                # Add polygons to the kml file with styling
+                for value, i, j, polygon in cells:
+                    # Only create placemarks for values that are not no data values
+                    if value:
+                        # Create a new placemark for each group of values
+                        if value != groupValue:
+                            multigeometry = self._addGridPlacemark(document, mappedColorRamp, value, i, j, timeSpan)
+                            groupValue = value
 
-            result = self._session.execute(statement)
+                        # Append the cell polygon to the current multigeometry group
+                        multigeometry.append(polygon)
 
-            # Set initial group value
-            groupValue = -9999999.0
+        return ET.tostring(kml)
 
-            # Add polygons to the kml file with styling
-            for row in result:
-                # Value will be None if it is a no data value
-                if row.val:
-                    value = float(row.val)
-                else:
-                    value = None
-
-                polygonString = row.polygon
-                i = int(row.x)
-                j = int(row.y)
-
-                # Only create placemarks for values that are not no data values
-                if value:
-                    if value not in uniqueValues:
-                        uniqueValues.append(value)
-
-                    # Create a new placemark for each group of values
-                    if value != groupValue:
-                        placemark = ET.SubElement(document, 'Placemark')
-                        placemarkName = ET.SubElement(placemark, 'name')
-                        placemarkName.text = str(value)
-
-                        # Create style tag and setup styles
-                        style = ET.SubElement(placemark, 'Style')
-
-                        # Set polygon line style
-                        lineStyle = ET.SubElement(style, 'LineStyle')
-
-                        # Set polygon line color and width
-                        lineColor = ET.SubElement(lineStyle, 'color')
-                        lineColor.text = self.LINE_COLOR
-                        lineWidth = ET.SubElement(lineStyle, 'width')
-                        lineWidth.text = str(self.LINE_WIDTH)
-
-                        # Set polygon fill color
-                        polyStyle = ET.SubElement(style, 'PolyStyle')
-                        polyColor = ET.SubElement(polyStyle, 'color')
-
-                        # Convert alpha from 0.0-1.0 decimal to 00-FF string
-                        integerAlpha = mappedColorRamp.getAlphaAsInteger()
-
-                        # Get RGB color from color ramp and convert to KML hex ABGR string with alpha
-                        integerRGB = mappedColorRamp.getColorForValue(value)
-                        hexABGR = '%02X%02X%02X%02X' % (integerAlpha,
-                                                        integerRGB[mappedColorRamp.B],
-                                                        integerRGB[mappedColorRamp.G],
-                                                        integerRGB[mappedColorRamp.R])
-
-                        # Set the polygon fill alpha and color
-                        polyColor.text = hexABGR
-
-                        if deltaTime:
-                            # Create TimeSpan tag
-                            timeSpan = ET.SubElement(placemark, 'TimeSpan')
-
-                            # Create begin and end tags
-                            begin = ET.SubElement(timeSpan, 'begin')
-                            begin.text = prevDateTime.strftime('%Y-%m-%dT%H:%M:%S')
-                            end = ET.SubElement(timeSpan, 'end')
-                            end.text = dateTime.strftime('%Y-%m-%dT%H:%M:%S')
-
-                        # Create multigeometry tag
-                        multigeometry = ET.SubElement(placemark, 'MultiGeometry')
-
-                        # Create the data tag
-                        extendedData = ET.SubElement(placemark, 'ExtendedData')
-
-                        # Add value to data
-                        valueData = ET.SubElement(extendedData, 'Data', name='value')
-                        valueValue = ET.SubElement(valueData, 'value')
-                        valueValue.text = str(value)
-
-                        iData = ET.SubElement(extendedData, 'Data', name='i')
-                        valueI = ET.SubElement(iData, 'value')
-                        valueI.text = str(i)
-
-                        jData = ET.SubElement(extendedData, 'Data', name='j')
-                        valueJ = ET.SubElement(jData, 'value')
-                        valueJ.text = str(j)
-
-                        if deltaTime:
-                            tData = ET.SubElement(extendedData, 'Data', name='t')
-                            valueT = ET.SubElement(tData, 'value')
-                            valueT.text = dateTime.strftime('%Y-%m-%dT%H:%M:%S')
-
-                        groupValue = value
-
-                    # Get polygon object from kml string and append to the current multigeometry group
-                    polygon = ET.fromstring(polygonString)
-                    multigeometry.append(polygon)
+    def _addGridPlacemark(self, document, mappedColorRamp, value, i, j, timeSpan=None):
+        """
+        Add a styled placemark for a group of grid cells with the same value to the document and return its
+        MultiGeometry element for the cell polygons. The timeSpan is a (begin, end) tuple of datetimes or None.
+        """
+        placemark = ET.SubElement(document, 'Placemark')
+        placemarkName = ET.SubElement(placemark, 'name')
+        placemarkName.text = str(value)
 
-        if not discreet:
-            # Embed the color ramp in SLD format
-            document.append(ET.fromstring(mappedColorRamp.getColorMapAsContinuousSLD()))
-        else:
-            # Sort the unique values
-            uniqueValues.sort()
-            document.append(ET.fromstring(mappedColorRamp.getColorMapAsDiscreetSLD(uniqueValues)))
+        # Create style tag and setup styles
+        style = ET.SubElement(placemark, 'Style')
 
-        return ET.tostring(kml)
+        # Set polygon line style
+        lineStyle = ET.SubElement(style, 'LineStyle')
+
+        # Set polygon line color and width
+        lineColor = ET.SubElement(lineStyle, 'color')
+        lineColor.text = self.LINE_COLOR
+        lineWidth = ET.SubElement(lineStyle, 'width')
+        lineWidth.text = str(self.LINE_WIDTH)
+
+        # Set polygon fill color
+        polyStyle = ET.SubElement(style, 'PolyStyle')
+        polyColor = ET.SubElement(polyStyle, 'color')
+
+        # Convert alpha from 0.0-1.0 decimal to 00-FF string
+        integerAlpha = mappedColorRamp.getAlphaAsInteger()
+
+        # Get RGB color from color ramp and convert to KML hex ABGR string with alpha
+        integerRGB = mappedColorRamp.getColorForValue(value)
+        hexABGR = '%02X%02X%02X%02X' % (integerAlpha,
+                                        integerRGB[mappedColorRamp.B],
+                                        integerRGB[mappedColorRamp.G],
+                                        integerRGB[mappedColorRamp.R])
+
+        # Set the polygon fill alpha and color
+        polyColor.text = hexABGR
+
+        if timeSpan:
+            beginDateTime, endDateTime = timeSpan
+
+            # Create TimeSpan tag
+            timeSpanElement = ET.SubElement(placemark, 'TimeSpan')
+
+            # Create begin and end tags
+            begin = ET.SubElement(timeSpanElement, 'begin')
+            begin.text = beginDateTime.strftime('%Y-%m-%dT%H:%M:%S')
+            end = ET.SubElement(timeSpanElement, 'end')
+            end.text = endDateTime.strftime('%Y-%m-%dT%H:%M:%S')
+
+        # Create multigeometry tag
+        multigeometry = ET.SubElement(placemark, 'MultiGeometry')
+
+        # Create the data tag
+        extendedData = ET.SubElement(placemark, 'ExtendedData')
 
+        # Add value to data
+        valueData = ET.SubElement(extendedData, 'Data', name='value')
+        valueValue = ET.SubElement(valueData, 'value')
+        valueValue.text = str(value)
 
+        iData = ET.SubElement(extendedData, 'Data', name='i')
+        valueI = ET.SubElement(iData, 'value')
+        valueI.text = str(i)
 
+        jData = ET.SubElement(extendedData, 'Data', name='j')
+        valueJ = ET.SubElement(jData, 'value')
+        valueJ.text = str(j)
+
+        if timeSpan:
+            tData = ET.SubElement(extendedData, 'Data', name='t')
+            valueT = ET.SubElement(tData, 'value')
+            valueT.text = endDateTime.strftime('%Y-%m-%dT%H:%M:%S')
+
+        return multigeometry
+
+    def _addDeltaGridPlacemarks(self, document, mappedColorRamp, frames, timeSpans):
+        """
+        Add placemarks to the document only where the value of a cell changes. Each run of frames in which a cell
+        keeps the same value gets one TimeSpan covering the whole run, and the cells with the same value and run are
+        grouped in one placemark.
+        """
+        # Cells with an open run: (i, j) -> (value, first frame index, polygon)
+        openRuns = dict()
+
+        # Closed runs: (first frame index, last frame index, value) -> list of (j, i, polygon)
+        runs = dict()
+        lastIndex = -1
+
+        for index, cells in enumerate(frames):
+            # Only no data values are left out
+            frameCells = dict(((i, j), (value, polygon)) for value, i, j, polygon in cells if value)
+
+            for cell, (value, first, polygon) in list(openRuns.items()):
+                if cell not in frameCells or frameCells[cell][0] != value:
+                    runs.setdefault((first, index - 1, value), []).append((cell[1], cell[0], polygon))
+                    del openRuns[cell]
+
+            for cell, (value, polygon) in frameCells.items():
+                if cell not in openRuns:
+                    openRuns[cell] = (value, index, polygon)
+
+            lastIndex = index
+
+        for cell, (value, first, polygon) in openRuns.items():
+            runs.setdefault((first, lastIndex, value), []).append((cell[1], cell[0], polygon))
+
+        for first, last, value in sorted(runs):
+            cells = sorted(runs[(first, last, value)], key=lambda cell: (cell[0], cell[1]))
+            j, i, polygon = cells[0]
+
+            if timeSpans:
+                timeSpan = (timeSpans[first][0], timeSpans[last][1])
+            else:
+                timeSpan = None
+
+            multigeometry = self._addGridPlacemark(document, mappedColorRamp, value, i, j, timeSpan)
+
+            for j, i, polygon in cells:
+                multigeometry.append(polygon)
+
+    def _haveSameGrid(self, session, table, rasterIds, rasterField, rasterIdField):
+        """
+        Return True if the given rasters all have the same dimensions, georeference and spatial reference, so the
+        cells of one of them can be used for all of them. Only the raster headers are read.
+        """
+        statement = prepareStatement('''
+                    SELECT count(DISTINCT (md.upperleftx, md.upperlefty, md.width, md.height, md.scalex, md.scaley,
+                                           md.skewx, md.skewy, md.srid)) AS grids
+                    FROM (
+                    SELECT (ST_MetaData({raster})).*
+                    FROM {table}
+                    WHERE {rasterId} = ANY(:rasterIds)
+                    ) AS md;
+                    ''', raster=rasterField, table=table, rasterId=rasterIdField)
+
+        grids = session.execute(statement, {'rasterIds': coerceIds(rasterIds)}).scalar()
+
+        return grids == 1
+
+    def _iterGridCells(self, tableName, rasterIds, rasterFieldName, rasterIdFieldName, bbox, bboxSrid, precision=None):
+        """
+        Generator that yields the cells of each raster, polygonizing every raster. The cells of a raster are
+        (value, i, j, polygon) tuples ordered by value, where value is None for no data and polygon is a KML element.
+        """
+        statement = prepareStatement('''
+                    SELECT x, y, val, ST_AsKML(geom, CAST(:precision AS integer)) AS polygon
+                    FROM (
+                    SELECT (ST_PixelAsPolygons(''' + self._clipToBbox('{raster}', bbox) + ''')).*
+                    FROM {table} WHERE {rasterId}=:rasterId''' + self._bboxCondition('{raster}', bbox, self._session, tableName) + '''
+                    ) AS foo
+                    ORDER BY val;
+                    ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
+
+        parameters = dict(self._getBboxParameters(bbox, bboxSrid),
+                          precision=self._getPrecision(precision, self.KML_PRECISION))
+
+        for rasterId in rasterIds:
+            result = self._session.execute(statement, dict(parameters, rasterId=rasterId))
+
+            # Value will be None if it is a no data value
+            yield [(float(row.val) if row.val else None, int(row.x), int(row.y), ET.fromstring(row.polygon))
+                   for row in result]
+
+    def _iterSharedGridCells(self, tableName, rasterIds, rasterFieldName, rasterIdFieldName, bbox, bboxSrid,
+                             precision=None):
+        """
+        Generator that yields the cells of each raster like _iterGridCells for rasters that share the same grid. The
+        cell polygons are computed from the first raster only and each polygon element is reused by every frame; only
+        the values are fetched for each raster.
+        """
+        parameters = dict(self._getBboxParameters(bbox, bboxSrid),
+                          precision=self._getPrecision(precision, self.KML_PRECISION))
+
+        # Polygons of every cell (including no data cells) in kml format
+        statement = prepareStatement('''
+                    SELECT x, y, ST_AsKML(geom, CAST(:precision AS integer)) AS polygon
+                    FROM (
+                    SELECT (ST_PixelAsPolygons(''' + self._clipToBbox('{raster}', bbox) + ''', 1, false)).*
+                    FROM {table} WHERE {rasterId}=:rasterId''' + self._bboxCondition('{raster}', bbox, self._session, tableName) + '''
+                    ) AS foo;
+                    ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
+
+        result = self._session.execute(statement, dict(parameters, rasterId=rasterIds[0]))
+        polygonStrings = dict(((int(row.x), int(row.y)), row.polygon) for row in result)
+
+        # Parsed when a cell is first used
+        polygons = dict()
+
+        # Values of band 1 as a rows x columns array with no data values as NULL
+        statement = prepareStatement('''
+                    SELECT ST_DumpValues(''' + self._clipToBbox('{raster}', bbox) + ''', 1) AS vals
+                    FROM {table} WHERE {rasterId}=:rasterId''' + self._bboxCondition('{raster}', bbox, self._session, tableName) + ''';
+                    ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
+
+        for rasterId in rasterIds:
+            values = self._session.execute(statement, dict(parameters, rasterId=rasterId)).scalar() or []
+
+            cells = []
+            for j, rowValues in enumerate(values, start=1):
+                for i, value in enumerate(rowValues, start=1):
+                    if value is not None:
+                        cells.append((float(value), i, j))
+
+            # Same order as polygonizing the frame (sort is stable, so cells with the same value stay in row order)
+            cells.sort(key=lambda cell: cell[0])
+
+            frameCells = []
+            for value, i, j in cells:
+                if (i, j) not in polygons:
+                    polygons[(i, j)] = ET.fromstring(polygonStrings[(i, j)])
+                frameCells.append((value, i, j, polygons[(i, j)]))
+
+            yield frameCells
+
+
+
+    @sessionPerCall
     def getAsKmlPngAnimation(self, tableName, timeStampedRasters=[], rasterIdFieldName='id', rasterFieldName='raster',
                              documentName='default', noDataValue=0, alpha=1.0, drawOrder=0, cellSize=None,
-                             resampleMethod='NearestNeighbour', discreet=False):
+                             resampleMethod='NearestNeighbour', discreet=False, maxPixels=None, maxSize=None,
+                             bbox=None, bboxSrid=4326, precision=None, palette=False, warpMethod=None,
+                             wgs84Copy=False):
         """
         Return a sequence of rasters with timestamps as a kml with time markers for animation.
 
@@ -688,6 +1194,15 @@ class RasterConverter(object):
         :param cellSize: Specify this parameter to resample the rasters to a different size the cells (e.g.: 30 to
                          resample to cells with dimensions 30 x 30 in units of the raster spatial reference system).
                          NOTE: the processing time increases exponentially with shrinking cellSize values.
+        :param maxPixels: Resample the rasters so each PNG has at most this many pixels (alternative to cellSize).
+        :param maxSize: Tuple of (maxWidth, maxHeight) in pixels to resample the rasters to fit within (alternative to cellSize).
+        :param bbox: Bounding box (minX, minY, maxX, maxY) to limit the rendering to (default is the whole raster)
+        :param bboxSrid: Spatial reference ID of the bounding box coordinates (default is 4326)
+        :param precision: Number of decimal places of the coordinates (default is full precision)
+        :param palette: Return 8-bit palette PNGs with the colors of the color ramp instead of RGBA PNGs
+        :param warpMethod: Warp the values to WGS 84 with this resampling method before they are colored
+        :param wgs84Copy: Render the WGS 84 copies of the rasters made by buildWgs84Copies (stale copies are not
+                          detected; build them again when the rasters change)
 
         :rtype : (string, list)
 
@@ -741,48 +1256,47 @@ class RasterConverter(object):
                                        rasterField=rasterFieldName,
                                        rasterIdField=rasterIdFieldName,
                                        cellSize=cellSize,
-                                       resampleMethod=resampleMethod)
-
-        binaryPNGs = []
+                                       resampleMethod=resampleMethod,
+                                       maxPixels=maxPixels,
+                                       maxSize=maxSize,
+                                       bbox=bbox,
+                                       bboxSrid=bboxSrid,
+                                       palette=palette,
+                                       mappedColorRamp=mappedColorRamp,
+                                       warpMethod=warpMethod,
+                                       wgs84Copy=wgs84Copy)
+
+        # Order the PNGs the same as the time stamped rasters
+        rowsById = dict()
 
         for row in result:
-            binaryPNGs.append(row.png)
+            rowsById[str(row.rid)] = row
 
-        # Determine extents for the KML wrapper file via query
-        statement = '''
-                    SELECT (foo.metadata).*
-                    FROM (
-                    SELECT ST_MetaData(ST_Transform({0}, 4326, 'Bilinear')) as metadata
-                    FROM {1}
-                    WHERE {2}={3}
-                    ) As foo;
-                    '''.format(rasterFieldName, tableName, rasterIdFieldName, rasterIds[0])
+        missingIds = [rasterId for rasterId in rasterIds if rasterId not in rowsById]
 
-        result = self._session.execute(statement)
+        if missingIds:
+            raise ValueError('RASTER CONVERSION ERROR: rasters {0} could not be found or do not intersect the '
+                             'bounding box.'.format(', '.join(missingIds)))
 
-        for row in result:
-            upperLeftY = row.upperlefty
-            scaleY = row.scaley
-            height = row.height
-
-            upperLeftX = row.upperleftx
-            scaleX = row.scalex
-            width = row.width
-
-        north = upperLeftY
-        south = upperLeftY + (scaleY * height)
-        east = upperLeftX + (scaleX * width)
-        west = upperLeftX
-
-        # Default to time delta to None
-        deltaTime = None
+        if palette:
+            binaryPNGs = [self.getPalettePng(rowsById[rasterId].indexed, mappedColorRamp) for rasterId in rasterIds]
+        else:
+            binaryPNGs = [rowsById[rasterId].png for rasterId in rasterIds]
 
-        # Calculate delta time between images if more than one
-        time1 = timeStampedRasters[0]['dateTime']
+        # Determine extents for the KML wrapper file
+        if bbox is not None:
+            # The extent of the clipped PNGs
+            firstRow = rowsById[rasterIds[0]]
+            north, south, east, west = firstRow.north, firstRow.south, firstRow.east, firstRow.west
+        else:
+            north, south, east, west = self.getWgs84ExtentOfRaster(session=self._session,
+                                                                   table=tableName,
+                                                                   rasterId=rasterIds[0],
+                                                                   rasterField=rasterFieldName,
+                                                                   rasterIdField=rasterIdFieldName)
 
-        if len(timeStampedRasters) >= 2:
-            time2 = timeStampedRasters[1]['dateTime']
-            deltaTime = time2 - time1
+        # Time span of each frame (None if there is only one frame)
+        timeSpans = self.getTimeSpans(timeStampedRasters)
 
         # Initialize KML Document
         kml = ET.Element('kml', xmlns='http://www.opengis.net/kml/2.2')
@@ -794,8 +1308,16 @@ class RasterConverter(object):
             # Embed the color ramp in SLD format
             document.append(ET.fromstring(mappedColorRamp.getColorMapAsContinuousSLD()))
         else:
-            values = []
-            document.append(ET.fromstring(mappedColorRamp.getColorMapAsDiscreetSLD(values)))
+            # Determine values for discreet color ramp from all of the frames
+            valueCounts = self.getValueCountsOfRasters(session=self._session,
+                                                       table=tableName,
+                                                       rasterIds=rasterIds,
+                                                       rasterField=rasterFieldName,
+                                                       rasterIdField=rasterIdFieldName,
+                                                       bbox=bbox,
+                                                       bboxSrid=bboxSrid)
+            uniqueValues = [value for value, count in valueCounts]
+            document.append(ET.fromstring(mappedColorRamp.getColorMapAsDiscreetSLD(uniqueValues)))
 
         # Apply special style to hide legend items
         style = ET.SubElement(document, 'Style', id='check-hide-children')
@@ -807,9 +1329,8 @@ class RasterConverter(object):
 
         for index, timeStampedRaster in enumerate(timeStampedRasters):
             # Extract variable
-            if deltaTime:
-                dateTime = timeStampedRaster['dateTime']
-                prevDateTime = dateTime - deltaTime
+            if timeSpans:
+                prevDateTime, dateTime = timeSpans[index]
 
 
             # GroundOverlay
@@ -817,7 +1338,7 @@ class RasterConverter(object):
             overlayName = ET.SubElement(groundOverlay, 'name')
             overlayName.text = 'Overlay'
 
-            if deltaTime:
+            if timeSpans:
                 # Create TimeSpan tag
                 timeSpan = ET.SubElement(groundOverlay, 'TimeSpan')
 
@@ -836,16 +1357,16 @@ class RasterConverter(object):
             latLonBox = ET.SubElement(regionElement, 'LatLonBox')
 
             northElement = ET.SubElement(latLonBox, 'north')
-            northElement.text = str(north)
+            northElement.text = formatCoordinate(north, precision)
 
             southElement = ET.SubElement(latLonBox, 'south')
-            southElement.text = str(south)
+            southElement.text = formatCoordinate(south, precision)
 
             eastElement = ET.SubElement(latLonBox, 'east')
-            eastElement.text = str(east)
+            eastElement.text = formatCoordinate(east, precision)
 
             westElement = ET.SubElement(latLonBox, 'west')
-            westElement.text = str(west)
+            westElement.text = formatCoordinate(west, precision)
 
             # Href to PNG
             iconElement = ET.SubElement(groundOverlay, 'Icon')
@@ -856,19 +1377,137 @@ class RasterConverter(object):
             latLonBox = ET.SubElement(groundOverlay, 'LatLonBox')
 
             northElement = ET.SubElement(latLonBox, 'north')
-            northElement.text = str(north)
+            northElement.text = formatCoordinate(north, precision)
 
             southElement = ET.SubElement(latLonBox, 'south')
-            southElement.text = str(south)
+            southElement.text = formatCoordinate(south, precision)
 
             eastElement = ET.SubElement(latLonBox, 'east')
-            eastElement.text = str(east)
+            eastElement.text = formatCoordinate(east, precision)
 
             westElement = ET.SubElement(latLonBox, 'west')
-            westElement.text = str(west)
+            westElement.text = formatCoordinate(west, precision)
 
         return ET.tostring(kml), binaryPNGs
 
+    @sessionPerCall
+    def getAsKmlGridAnimationByTime(self, tableName, startTime=None, endTime=None, stride=1, rasterIdFieldName='id',
+                                    rasterFieldName='raster', timestampFieldName='timestamp', **kwargs):
+        """
+        Return the rasters of a table that fall within a time range as a kml with time markers for animation. The
+        frames are selected and ordered by timestamp in the database. Accepts the same keyword arguments as
+        getAsKmlGridAnimation.
+
+        :param tableName: Name of the table to extract rasters from
+        :param startTime: datetime of the first frame to include (default is no lower bound)
+        :param endTime: datetime of the last frame to include (default is no upper bound)
+        :param stride: Include every nth raster in the time range (default is 1, every raster)
+        :param rasterIdFieldName: Name of the id field for rasters (usually the primary key field)
+        :param rasterFieldName: Name of the field where rasters are stored (of type raster)
+        :param timestampFieldName: Name of the field with the time of each raster
+
+        :rtype : string
+        """
+        timeStampedRasters = self.getTimeStampedRasters(session=self._session,
+                                                        tableName=tableName,
+                                                        startTime=startTime,
+                                                        endTime=endTime,
+                                                        stride=stride,
+                                                        rasterIdField=rasterIdFieldName,
+                                                        timestampField=timestampFieldName)
+
+        return self.getAsKmlGridAnimation(tableName=tableName,
+                                          timeStampedRasters=timeStampedRasters,
+                                          rasterIdFieldName=rasterIdFieldName,
+                                          rasterFieldName=rasterFieldName,
+                                          **kwargs)
+
+    @sessionPerCall
+    def getAsKmlPngAnimationByTime(self, tableName, startTime=None, endTime=None, stride=1, rasterIdFieldName='id',
+                                   rasterFieldName='raster', timestampFieldName='timestamp', **kwargs):
+        """
+        Return the rasters of a table that fall within a time range as a kml with time markers for animation and a
+        list of PNGs. The frames are selected and ordered by timestamp in the database. Accepts the same keyword
+        arguments as getAsKmlPngAnimation.
+
+        :param tableName: Name of the table to extract rasters from
+        :param startTime: datetime of the first frame to include (default is no lower bound)
+        :param endTime: datetime of the last frame to include (default is no upper bound)
+        :param stride: Include every nth raster in the time range (default is 1, every raster)
+        :param rasterIdFieldName: Name of the id field for rasters (usually the primary key field)
+        :param rasterFieldName: Name of the field where rasters are stored (of type raster)
+        :param timestampFieldName: Name of the field with the time of each raster
+
+        :rtype : (string, list)
+        """
+        timeStampedRasters = self.getTimeStampedRasters(session=self._session,
+                                                        tableName=tableName,
+                                                        startTime=startTime,
+                                                        endTime=endTime,
+                                                        stride=stride,
+                                                        rasterIdField=rasterIdFieldName,
+                                                        timestampField=timestampFieldName)
+
+        return self.getAsKmlPngAnimation(tableName=tableName,
+                                         timeStampedRasters=timeStampedRasters,
+                                         rasterIdFieldName=rasterIdFieldName,
+                                         rasterFieldName=rasterFieldName,
+                                         **kwargs)
+
+    def getTimeStampedRasters(self, session, tableName, startTime=None, endTime=None, stride=1, rasterIdField='id',
+                              timestampField='timestamp'):
+        """
+        Return a list of dictionaries with keys rasterId and dateTime for the rasters in the time range, ordered by
+        time. Only the id and timestamp columns are read, so the index on the timestamp column can be used.
+        """
+        if not (isinstance(stride, int) and stride >= 1):
+            raise ValueError('RASTER CONVERSION ERROR: stride must be an integer greater than or equal to 1.')
+
+        statement = prepareStatement('''
+                    SELECT rid, ts
+                    FROM (
+                    SELECT {rasterId} AS rid, {timestamp} AS ts, row_number() OVER (ORDER BY {timestamp}, {rasterId}) AS frame
+                    FROM {table}
+                    WHERE {timestamp} IS NOT NULL
+                    AND (CAST(:startTime AS timestamp) IS NULL OR {timestamp} >= :startTime)
+                    AND (CAST(:endTime AS timestamp) IS NULL OR {timestamp} <= :endTime)
+                    ) AS foo
+                    WHERE (frame - 1) % :stride = 0
+                    ORDER BY ts, rid;
+                    ''', rasterId=rasterIdField, timestamp=timestampField, table=tableName)
+
+        result = session.execute(statement, {'startTime': startTime, 'endTime': endTime, 'stride': stride})
+
+        timeStampedRasters = []
+
+        for row in result:
+            timeStampedRasters.append({'rasterId': row.rid, 'dateTime': row.ts})
+
+        if not timeStampedRasters:
+            raise ValueError('RASTER CONVERSION ERROR: no rasters with timestamps found in the time range.')
+
+        return timeStampedRasters
+
+    @classmethod
+    def getTimeSpans(cls, timeStampedRasters):
+        """
+        Return a list of (begin, end) datetime tuples, one for each time stamped raster. Each frame begins at the time
+        of the previous frame and ends at its own time. The first frame is given the same length as the second.
+        Returns None if there are less than two frames.
+        """
+        if len(timeStampedRasters) < 2:
+            return None
+
+        dateTimes = [timeStampedRaster['dateTime'] for timeStampedRaster in timeStampedRasters]
+
+        timeSpans = [(dateTimes[0] - (dateTimes[1] - dateTimes[0]), dateTimes[0])]
+
+        for index in range(1, len(dateTimes)):
+            timeSpans.append((dateTimes[index - 1], dateTimes[index]))
+
+        return timeSpans
+
+    @sessionPerCall
     def getAsGrassAsciiRaster(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster',
                               newSRID=None, dataType=None):
         """
@@ -901,162 +1540,421 @@ class RasterConverter(object):
         yLLCorner = float(arcInfoGrid[3].split()[1])
         cellSize = float(arcInfoGrid[4].split()[1])
 
-        # Remove old headers
-        for i in range(0, 5):
-            arcInfoGrid.pop(0)
+        # Skip old headers and the NODATA_value row if it is there
+        firstRow = 5
 
-        # Check for NODATA_value row and remove if it is there
-        if 'NODATA_value' in arcInfoGrid[0]:
-            arcInfoGrid.pop(0)
+        if 'NODATA_value' in arcInfoGrid[firstRow]:
+            firstRow += 1
 
         ## Calculate values for GRASS ASCII headers ##
-        # These should look like this:
-        # north: 4501028.972140
-        # south: 4494548.972140
-        # east: 460348.288604
-        # west: 454318.288604
-        # rows: 72
-        # cols: 67
-        # ...
-
         # xLLCorner and yLLCorner represent the coordinates for the Lower Left corner of the raster
         north = yLLCorner + (cellSize * nRows)
         south = yLLCorner
         east = xLLCorner + (cellSize * nCols)
         west = xLLCorner
 
-        # Create header Lines (the first shall be last and the last shall be first)
-        grassHeader = ['cols: %s' % nCols,
-                       'rows: %s' % nRows,
-                       'west: %s' % west,
-                       'east: %s' % east,
-                       'south: %s' % south,
-                       'north: %s' % north]
+        # Create string
+        grassHeader = self._getGrassAsciiHeader(north, south, east, west, nRows, nCols)
+        return '\n'.join(itertools.chain(grassHeader, itertools.islice(arcInfoGrid, firstRow, None)))
 
-        # Insert grass headers into the grid
-        for header in grassHeader:
-            arcInfoGrid.insert(0, header)
+    @sessionPerCall
+    def writeGrassAsciiRaster(self, fileObject, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster',
+                              newSRID=None, dataType=None):
+        """
+        Writes the raster in GRASS ASCII raster format to a file-like object one row at a time. The values are read
+        directly from the binary band data of the raster instead of an intermediate ArcInfo Grid string. No data cells
+        (and NaN cells of floating point bands) are written as "*", the GRASS null value.
+        :param fileObject: Text file-like object to write to
+        :param dataType: One of "Int32", "Float32" or "Float64". Defaults to the data type of the raster band.
+        """
+        if dataType and dataType not in self.GDAL_ASCII_DATA_TYPES:
+            raise ValueError('"{}" is not a valid data type. Must be one of "{}"'.format(
+                dataType, '", "'.join(self.GDAL_ASCII_DATA_TYPES)))
 
-        # Create string
-        arcInfoGridString = '\n'.join(arcInfoGrid)
-        return arcInfoGridString
+        if newSRID:
+            statement = prepareStatement('''
+                        SELECT ST_AsBinary(ST_Transform({raster}, CAST(:srid AS integer)))
+                        FROM {table} WHERE {rasterId}=:rasterId;
+                        ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
+        else:
+            statement = prepareStatement('''
+                        SELECT ST_AsBinary({raster})
+                        FROM {table} WHERE {rasterId}=:rasterId;
+                        ''', raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
+
+        wellKnownBinary = self._session.execute(statement, {'srid': newSRID, 'rasterId': rasterId}).scalar()
+
+        if wellKnownBinary is None:
+            raise ValueError('RASTER CONVERSION ERROR: raster {0} could not be found.'.format(rasterId))
+
+        raster = WKBRasterReader(wellKnownBinary)
+        band = raster.getBand(1)
+        north, south, east, west = raster.getExtent()
+
+        for header in self._getGrassAsciiHeader(north, south, east, west, raster.height, raster.width):
+            fileObject.write(header)
+            fileObject.write('\n')
+
+        # Format values the way the ArcInfo Grid driver would for the data type
+        if dataType == 'Int32' or (not dataType and band.pixelType not in (10, 11)):
+            formatValue = lambda value: str(int(value))
+        elif dataType == 'Float32' or (not dataType and band.pixelType == 10):
+            formatValue = lambda value: '{0:.8g}'.format(value)
+        else:
+            formatValue = repr
 
+        noDataValue = band.noDataValue
 
-    def getAsGdalRaster(self, rasterFieldName, tableName, rasterIdFieldName, rasterId, gdalFormat, newSRID=None, **kwargs):
+        def formatCell(value):
+            # NaN is the only value that is not equal to itself
+            if value == noDataValue or value != value:
+                return '*'
+
+            return formatValue(value)
+
+        for row in band.iterRows():
+            fileObject.write(' '.join(map(formatCell, row)))
+            fileObject.write('\n')
+
+    @classmethod
+    def _getGrassAsciiHeader(cls, north, south, east, west, rows, cols):
+        """
+        Return the GRASS ASCII header lines. These should look like this:
+        north: 4501028.972140
+        south: 4494548.972140
+        east: 460348.288604
+        west: 454318.288604
+        rows: 72
+        cols: 67
+        """
+        return ['north: %s' % north,
+                'south: %s' % south,
+                'east: %s' % east,
+                'west: %s' % west,
+                'rows: %s' % rows,
+                'cols: %s' % cols]
+
+    @sessionPerCall
+    def getAsGdalRaster(self, rasterFieldName, tableName, rasterIdFieldName, rasterId, gdalFormat, newSRID=None,
+                        binary=False, **kwargs):
         """
         Returns a string/buffer representation of the raster in the specified format. Wrapper for
-        ST_AsGDALRaster function in the database.
+        ST_AsGDALRaster function in the database. Use binary=True for binary formats (e.g.: GTiff, HFA) to get the
+        driver output as a memoryview without decoding or copying it.
+        """
+        result = self._queryGdalRasters(rasterFieldName, tableName, rasterIdFieldName, (rasterId, ), gdalFormat,
+                                        newSRID, kwargs).first()
+
+        if result is None or result.data is None:
+            raise ValueError('RASTER CONVERSION ERROR: raster {0} could not be found.'.format(rasterId))
+
+        return self._convertGdalRaster(result.data, binary)
+
+    @sessionPerCall
+    def getAsGdalRasters(self, rasterFieldName, tableName, rasterIdFieldName, rasterIds, gdalFormat, newSRID=None,
+                         binary=False, **kwargs):
+        """
+        Returns a list of (rasterId, string/buffer) tuples with the rasters in the specified format. The format is
+        validated once for the whole batch and the rasters are exported in a single query.
+        """
+        result = self._queryGdalRasters(rasterFieldName, tableName, rasterIdFieldName, rasterIds, gdalFormat,
+                                        newSRID, kwargs)
+
+        exported = []
+
+        for row in result:
+            exported.append((row.rid, self._convertGdalRaster(row.data, binary)))
+
+        return exported
+
+    @sessionPerCall
+    def writeGdalRaster(self, fileObject, rasterFieldName, tableName, rasterIdFieldName, rasterId, gdalFormat,
+                        newSRID=None, chunkSize=1048576, **kwargs):
+        """
+        Writes the raster in the specified format to a binary file-like object in chunks of chunkSize bytes. The
+        driver output is written directly from the query result without intermediate copies.
+        Returns the number of bytes written.
+        """
+        result = self._queryGdalRasters(rasterFieldName, tableName, rasterIdFieldName, (rasterId, ), gdalFormat,
+                                        newSRID, kwargs).first()
+
+        if result is None or result.data is None:
+            raise ValueError('RASTER CONVERSION ERROR: raster {0} could not be found.'.format(rasterId))
+
+        data = memoryview(result.data)
+
+        for offset in range(0, len(data), chunkSize):
+            fileObject.write(data[offset:offset + chunkSize])
+
+        return len(data)
+
+    @sessionPerCall
+    def getAsCloudOptimizedGeoTiff(self, tableName, rasterId=1, rasterIdFieldName='id', rasterFieldName='raster',
+                                   newSRID=None, blockSize=512, compress='DEFLATE', resampling='NEAREST',
+                                   overviewLevels=(2, 4, 8, 16), overviewMode='auto'):
+        """
+        Returns the raster as a Cloud Optimized GeoTIFF (internally tiled, compressed, with internal overviews) so
+        clients can read only the blocks they need over HTTP range requests.
+
+        :param blockSize: Width and height of the internal tiles in pixels
+        :param compress: GeoTIFF compression (e.g.: 'DEFLATE', 'LZW', 'NONE')
+        :param resampling: Resampling method used to build the overviews (e.g.: 'NEAREST', 'AVERAGE')
+        :param overviewLevels: Overview decimation factors (used when the overviews are built client-side)
+        :param overviewMode: 'server' to use the COG driver of the database, 'client' to build the overviews with the
+                             GDAL Python bindings, or 'auto' to use the first one available. Without either, a tiled
+                             GeoTIFF without overviews is returned.
+
+        :rtype : memoryview or bytes
+        """
+        VALID_OVERVIEW_MODES = ('auto', 'server', 'client')
+
+        if overviewMode not in VALID_OVERVIEW_MODES:
+            raise ValueError('RASTER CONVERSION ERROR: overviewMode must be one of "{0}".'.format(
+                '", "'.join(VALID_OVERVIEW_MODES)))
+
+        serverCog = 'COG' in self.supportedGdalRasterFormats(self._session)
+
+        if overviewMode == 'server' and not serverCog:
+            raise ValueError('FORMAT NOT SUPPORTED: COG format is not supported in this PostGIS installation.')
+
+        if overviewMode == 'client' and not gdal_enabled:
+            raise ImportError('RASTER CONVERSION ERROR: the GDAL Python bindings are required to build overviews '
+                              'client-side.')
+
+        if serverCog and overviewMode in ('auto', 'server'):
+            # The COG driver tiles, compresses and builds the overviews in the database
+            return self.getAsGdalRaster(rasterFieldName, tableName, rasterIdFieldName, rasterId, 'COG', newSRID,
+                                        binary=True, BLOCKSIZE=blockSize, COMPRESS=compress, RESAMPLING=resampling,
+                                        OVERVIEWS='AUTO')
+
+        tiledGeoTiff = self.getAsGdalRaster(rasterFieldName, tableName, rasterIdFieldName, rasterId, 'GTiff', newSRID,
+                                            binary=True, TILED='YES', BLOCKXSIZE=blockSize, BLOCKYSIZE=blockSize,
+                                            COMPRESS=compress)
+
+        if not gdal_enabled:
+            log.warning('COG WARNING: neither the COG driver nor the GDAL Python bindings are available. '
+                        'Returning a tiled GeoTIFF without overviews.')
+            return tiledGeoTiff
+
+        return self._addGeoTiffOverviews(tiledGeoTiff, blockSize, compress, resampling, overviewLevels)
+
+    @classmethod
+    def _addGeoTiffOverviews(cls, geoTiff, blockSize, compress, resampling, overviewLevels):
+        """
+        Build overviews for a GeoTIFF with the GDAL Python bindings and copy it to a tiled GeoTIFF with the
+        overviews stored internally, laid out as a Cloud Optimized GeoTIFF.
         """
+        sourcePath = '/vsimem/mapkit_{0}_src.tif'.format(uuid.uuid4().hex)
+        targetPath = '/vsimem/mapkit_{0}_cog.tif'.format(uuid.uuid4().hex)
 
+        try:
+            gdal.FileFromMemBuffer(sourcePath, bytes(geoTiff))
+
+            dataset = gdal.Open(sourcePath, gdal.GA_Update)
+            dataset.BuildOverviews(resampling, list(overviewLevels))
+            dataset = None
+
+            gdal.Translate(targetPath, sourcePath, format='GTiff',
+                           creationOptions=['TILED=YES',
+                                            'BLOCKXSIZE={0}'.format(blockSize),
+                                            'BLOCKYSIZE={0}'.format(blockSize),
+                                            'COMPRESS={0}'.format(compress),
+                                            'COPY_SRC_OVERVIEWS=YES'])
+
+            size = gdal.VSIStatL(targetPath).size
+            target = gdal.VSIFOpenL(targetPath, 'rb')
+
+            try:
+                return gdal.VSIFReadL(1, size, target)
+            finally:
+                gdal.VSIFCloseL(target)
+        finally:
+            gdal.Unlink(sourcePath)
+            gdal.Unlink(targetPath)
+
+    def _queryGdalRasters(self, rasterFieldName, tableName, rasterIdFieldName, rasterIds, gdalFormat, newSRID, options):
+        """
+        Execute ST_AsGDALRaster for the given rasters. Returns the result with columns rid and data.
+        """
         # Check gdalFormat
-        if not (gdalFormat in RasterConverter.supportedGdalRasterFormats(self._session)):
-            raise ValueError('FORMAT NOT SUPPORTED: {0} format is not supported '
-                             'in this PostGIS installation.'.format(gdalFormat))
+        self.validateGdalRasterFormat(self._session, gdalFormat)
+
+        # Compile options
+        options = ['{0}={1}'.format(key, value) for key, value in options.items()] or None
 
-        # Setup srid
+        # Create statement (names are quoted so that their case is kept, as this path always did)
         if newSRID:
-            srid = ', {0}'.format(newSRID)
+            statement = prepareStatement('''
+                        SELECT {rasterId} AS rid, ST_AsGDALRaster({raster}, :gdalFormat, CAST(:options AS text[]), CAST(:srid AS integer)) AS data
+                        FROM {table} WHERE {rasterId} = ANY(:rasterIds);
+                        ''', alwaysQuote=True, raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
         else:
-            srid = ''
+            statement = prepareStatement('''
+                        SELECT {rasterId} AS rid, ST_AsGDALRaster({raster}, :gdalFormat, CAST(:options AS text[])) AS data
+                        FROM {table} WHERE {rasterId} = ANY(:rasterIds);
+                        ''', alwaysQuote=True, raster=rasterFieldName, table=tableName, rasterId=rasterIdFieldName)
 
-        # Compile options
-        if kwargs:
-            optionsList = []
-            for key, value in kwargs.items():
-                kwargString = "'{0}={1}'".format(key, value)
-                optionsList.append(kwargString)
-
-            optionsString = ','.join(optionsList)
-            options = ', ARRAY[{0}]'.format(optionsString)
-        else:
-            options = ''
+        # Execute query
+        return self._session.execute(statement, {'gdalFormat': gdalFormat,
+                                                 'options': options,
+                                                 'srid': newSRID,
+                                                 'rasterIds': coerceIds(rasterIds)})
 
-        # Create statement
-        statement = '''
-                    SELECT ST_AsGDALRaster("{0}", '{1}'{5}{6})
-                    FROM "{2}" WHERE "{3}"={4};
-                    '''.format(rasterFieldName, gdalFormat, tableName, rasterIdFieldName, rasterId,  options, srid)
+    @classmethod
+    def _convertGdalRaster(cls, data, binary):
+        """
+        Return the driver output as a memoryview (binary) or decoded text
+        """
+        if binary:
+            return memoryview(data)
 
-        # Execute query
-        result = self._session.execute(statement).scalar()
+        return str(data, 'utf-8')
 
-        return bytes(result).decode('utf-8')
+    @classmethod
+    def validateGdalRasterFormat(cls, sqlAlchemyEngineOrSession, gdalFormat):
+        """
+        Raise a ValueError if the GDAL raster format is not supported by the database. Uses the cached driver list.
+        """
+        if not (gdalFormat in cls.supportedGdalRasterFormats(sqlAlchemyEngineOrSession)):
+            raise ValueError('FORMAT NOT SUPPORTED: {0} format is not supported '
+                             'in this PostGIS installation.'.format(gdalFormat))
 
     @classmethod
-    def supportedGdalRasterFormats(cls, sqlAlchemyEngineOrSession):
+    def supportedGdalRasterFormats(cls, sqlAlchemyEngineOrSession, refresh=False):
         """
-        Return a list of the supported GDAL raster formats.
+        Return a dictionary of the supported GDAL raster formats. The driver list is queried once per engine and
+        shared by all converters; use refresh=True to query it again (e.g.: after upgrading PostGIS).
         """
+        ownsSession = False
+
+        if isinstance(sqlAlchemyEngineOrSession, Engine):
+            engine = sqlAlchemyEngineOrSession
+        else:
+            engine = sqlAlchemyEngineOrSession.get_bind()
+            engine = getattr(engine, 'engine', engine)
+
+        with cls._gdalDriverCacheLock:
+            if not refresh and engine in cls._gdalDriverCache:
+                return dict(cls._gdalDriverCache[engine])
+
         if isinstance(sqlAlchemyEngineOrSession, Engine):
             # Create sqlalchemy session
             sessionMaker = sessionmaker(bind=sqlAlchemyEngineOrSession)
             session = sessionMaker()
+            ownsSession = True
         elif isinstance(sqlAlchemyEngineOrSession, Session):
             session = sqlAlchemyEngineOrSession
 
         # Execute statement
-        statement = 'SELECT * FROM st_gdaldrivers() ORDER BY short_name;'
+        statement = prepareStatement('SELECT * FROM st_gdaldrivers() ORDER BY short_name;')
 
-        result = session.execute(statement)
+        try:
+            result = session.execute(statement)
 
-        supported = dict()
+            supported = dict()
 
-        for row in result:
-            supported[row[1]] = {'description': row[2], 'options': row[3]}
+            for row in result:
+                supported[row[1]] = {'description': row[2], 'options': row[3]}
+        finally:
+            if ownsSession:
+                session.close()
 
-        return supported
+        with cls._gdalDriverCacheLock:
+            cls._gdalDriverCache[engine] = supported
 
-    def setColorRamp(self, colorRamp=None):
-        """
-        Set the color ramp of the raster converter instance
-        """
-        if not colorRamp:
-            self._colorRamp = RasterConverter.setDefaultColorRamp(ColorRampEnum.COLOR_RAMP_HUE)
-        else:
-            self._colorRamp = colorRamp
+        return dict(supported)
 
-    def setDefaultColorRamp(self, colorRampEnum=ColorRampEnum.COLOR_RAMP_HUE):
+    @classmethod
+    def clearGdalDriverCache(cls):
         """
-        Returns the color ramp as a list of RGB tuples
+        Forget the cached GDAL driver lists of all engines.
         """
-        self._colorRamp = ColorRampGenerator.generateDefaultColorRamp(colorRampEnum)
+        with cls._gdalDriverCacheLock:
+            cls._gdalDriverCache.clear()
 
-    def setCustomColorRamp(self, colors=[], interpolatedPoints=10):
+    def getMinMaxOfRasters(self, session, table, rasterIds, rasterField, rasterIdField, noDataValue):
         """
-        Accepts a list of RGB tuples and interpolates between them to create a custom color ramp.
-        Returns the color ramp as a list of RGB tuples.
+        Return the minimum and maximum values of band 1 of the given rasters, excluding no data values. The persisted
+        statistics columns are used for rasters loaded with the same no data value.
         """
-        self._colorRamp = ColorRampGenerator.generateCustomColorRamp(colors, interpolatedPoints)
-
-    def getMinMaxOfRasters(self, session, table, rasterIds, rasterField, rasterIdField, noDataValue):
-        # Assemble rasters ids into string
-        rasterIdsString = '({0})'.format(', '.join(rasterIds))
-        for rasterId in rasterIds:
-            statement = '''
-                        UPDATE {1} SET {0} = ST_SetBandNoDataValue({0},1,{4})
-                        WHERE {2} = {3};
-                        '''.format(rasterField, table, rasterIdField, rasterId, noDataValue)
-
-            session.execute(statement)
-
-        # Get min and max for raster band 1
-        statement = '''
-                SELECT {2}, (stats).min, (stats).max
-                FROM (
-                SELECT {2}, ST_SummaryStats({0}, 1, true) As stats
-                FROM {1}
-                WHERE {2} IN {3}
-                ) As foo;
-                '''.format(rasterField, table, rasterIdField, rasterIdsString)
-        result = session.execute(statement)
-        # extract the stats
         minValues = []
         maxValues = []
-        for row in result:
-            if row.min is not None:
-                minValues.append(row.min)
-            if row.max is not None:
-                maxValues.append(row.max)
+        rasterIds = coerceIds(rasterIds)
+
+        if self.hasRasterMetadata(session, table):
+            # Use persisted statistics where they were computed with the same no data value
+            statement = prepareStatement('''
+                        SELECT {rasterId} AS rid, no_data_value, min_value, max_value
+                        FROM {table}
+                        WHERE {rasterId} = ANY(:rasterIds);
+                        ''', table=table, rasterId=rasterIdField)
+            result = session.execute(statement, {'rasterIds': rasterIds})
+
+            persistedIds = []
+            for row in result:
+                if row.no_data_value is not None and float(row.no_data_value) == float(noDataValue):
+                    persistedIds.append(row.rid)
+                    if row.min_value is not None:
+                        minValues.append(row.min_value)
+                    if row.max_value is not None:
+                        maxValues.append(row.max_value)
+
+            rasterIds = [rasterId for rasterId in rasterIds if rasterId not in persistedIds]
+
+        if rasterIds:
+            statement = prepareStatement('''
+                        UPDATE {table} SET {raster} = ST_SetBandNoDataValue({raster}, 1, :noDataValue)
+                        WHERE {rasterId} = ANY(:rasterIds);
+                        ''', raster=rasterField, table=table, rasterId=rasterIdField)
+
+            session.execute(statement, {'noDataValue': float(noDataValue), 'rasterIds': rasterIds})
+
+            if self.hasOverviews(session, table):
+                statement = prepareStatement('''
+                            UPDATE {overviews} SET raster = ST_SetBandNoDataValue(raster, 1, :noDataValue)
+                            WHERE raster_id = ANY(:rasterIds);
+                            ''', overviews=self.getOverviewTableName(table))
+
+                session.execute(statement, {'noDataValue': float(noDataValue), 'rasterIds': rasterIds})
+
+            if self.hasWgs84Copies(session, table):
+                statement = prepareStatement('''
+                            UPDATE {wgs84} SET raster = ST_SetBandNoDataValue(raster, 1, :noDataValue)
+                            WHERE raster_id = ANY(:rasterIds);
+                            ''', wgs84=self.getWgs84TableName(table))
+
+                session.execute(statement, {'noDataValue': float(noDataValue), 'rasterIds': rasterIds})
+
+            # Get min and max for raster band 1
+            statement = prepareStatement('''
+                    SELECT {rasterId}, (stats).min, (stats).max
+                    FROM (
+                    SELECT {rasterId}, ST_SummaryStats({raster}, 1, true) As stats
+                    FROM {table}
+                    WHERE {rasterId} = ANY(:rasterIds)
+                    ) As foo;
+                    ''', raster=rasterField, table=table, rasterId=rasterIdField)
+            result = session.execute(statement, {'rasterIds': rasterIds})
+            rasterStats = []
+
+            # extract the stats
+            for row in result:
+                rasterStats.append({'rasterId': row[0], 'minValue': row.min, 'maxValue': row.max,
+                                    'noDataValue': float(noDataValue)})
+                if row.min is not None:
+                    minValues.append(row.min)
+                if row.max is not None:
+                    maxValues.append(row.max)
+
+            if rasterStats and self.hasRasterMetadata(session, table):
+                # Keep the persisted statistics in step with the new no data value (the footprint does not change)
+                statement = prepareStatement('''
+                            UPDATE {table}
+                            SET no_data_value = :noDataValue, min_value = :minValue, max_value = :maxValue
+                            WHERE {rasterId} = :rasterId;
+                            ''', table=table, rasterId=rasterIdField)
+
+                session.execute(statement, rasterStats)
 
         # In the case of no min or max values, assume 0 and 1, respectively
         try:
@@ -1070,41 +1968,702 @@ class RasterConverter(object):
 
         return minValue, maxValue
 
-    def getRastersAsPngs(self, session, tableName, rasterIds, postGisRampString, rasterField='raster', rasterIdField='id',  cellSize=None, resampleMethod='NearestNeighbour'):
+    def getValueCountsOfRasters(self, session, table, rasterIds, rasterField, rasterIdField, bbox=None, bboxSrid=4326):
         """
-        Return the raster in a PNG format
+        Return the distinct values of band 1 of the given rasters, excluding no data values, with the number of cells
+        that have each value across all of the rasters. The values are counted in the database with ST_ValueCount.
+        :rtype: list of (value, count) tuples ordered by value
         """
-        # Validate
-        VALID_RESAMPLE_METHODS = ('NearestNeighbour', 'Bilinear', 'Cubic', 'CubicSpline', 'Lanczos')
+        statement = prepareStatement('''
+                    SELECT (pvc).value, sum((pvc).count) AS count
+                    FROM (
+                          SELECT ST_ValueCount(''' + self._clipToBbox('{raster}', bbox) + ''', 1, true) AS pvc
+                          FROM {table}
+                          WHERE {rasterId} = ANY(:rasterIds)''' + self._bboxCondition('{raster}', bbox, session, table) + '''
+                         ) AS foo
+                    GROUP BY (pvc).value
+                    ORDER BY (pvc).value;
+                    ''', raster=rasterField, table=table, rasterId=rasterIdField)
+
+        result = session.execute(statement, dict(self._getBboxParameters(bbox, bboxSrid),
+                                                 rasterIds=coerceIds(rasterIds)))
+
+        return [(row.value, int(row.count)) for row in result]
+
+    def getWgs84ExtentOfRaster(self, session, table, rasterId, rasterField, rasterIdField):
+        """
+        Return the north, south, east and west bounds of the raster in WGS 84. The persisted footprint is used when the
+        table has one, otherwise the raster is transformed to derive it.
+        :rtype: tuple of floats
+        """
+        if self.hasRasterMetadata(session, table):
+            statement = prepareStatement('''
+                        SELECT ST_YMax(footprint) AS north, ST_YMin(footprint) AS south,
+                               ST_XMax(footprint) AS east, ST_XMin(footprint) AS west
+                        FROM {table}
+                        WHERE {rasterId}=:rasterId;
+                        ''', table=table, rasterId=rasterIdField)
+
+            row = session.execute(statement, {'rasterId': rasterId}).first()
+
+            if row is not None and row.north is not None:
+                return row.north, row.south, row.east, row.west
+
+        # Determine extents via query
+        statement = prepareStatement('''
+                    SELECT (foo.metadata).*
+                    FROM (
+                    SELECT ST_MetaData(ST_Transform({raster}, 4326, 'Bilinear')) as metadata
+                    FROM {table}
+                    WHERE {rasterId}=:rasterId
+                    ) As foo;
+                    ''', raster=rasterField, table=table, rasterId=rasterIdField)
 
+        result = session.execute(statement, {'rasterId': rasterId})
+
+        for row in result:
+            upperLeftY = row.upperlefty
+            scaleY = row.scaley
+            height = row.height
+
+            upperLeftX = row.upperleftx
+            scaleX = row.scalex
+            width = row.width
+
+        north = upperLeftY
+        south = upperLeftY + (scaleY * height)
+        east = upperLeftX + (scaleX * width)
+        west = upperLeftX
+
+        return north, south, east, west
+
+    def hasRasterMetadata(self, session, table):
+        """
+        Return True if the table has the metadata columns populated by RasterLoader.updateRasterMetadata. The table is
+        looked up in its schema if it is schema qualified or else in the current schema. The result is cached per table.
+        """
+        if table not in self._metadataTables:
+            statement = prepareStatement('''
+                        SELECT column_name
+                        FROM information_schema.columns
+                        WHERE table_schema = COALESCE(CAST(:schema AS text), current_schema()) AND table_name = :table;
+                        ''')
+
+            schema, name = catalogName(table)
+            result = session.execute(statement, {'schema': schema, 'table': name})
+            columns = set(row[0] for row in result)
+            self._metadataTables[table] = all(column in columns for column in self.RASTER_METADATA_COLUMNS)
+
+        return self._metadataTables[table]
+
+    @sessionPerCall
+    def buildOverviews(self, tableName, rasterIds=None, factors=(2, 4, 8, 16), rasterIdFieldName='id',
+                       rasterFieldName='raster', resampleMethod='NearestNeighbour'):
+        """
+        Build reduced resolution copies (overviews) of the rasters of a table and store them in the overview table
+        of the table (see getOverviewTableName). PNG renders with a cellSize then start from the coarsest overview
+        that is at least as fine as the requested cell size instead of the full resolution raster. Existing overviews
+        of the rasters are replaced. Overviews are not rebuilt when the rasters change; call buildOverviews again for
+        the changed rasters.
+
+        :param tableName: Name of the table with the rasters
+        :param rasterIds: List of ids of the rasters to build overviews for (default is all rasters in the table)
+        :param factors: Reduction factors of the overviews (e.g.: 2 for half the width and height)
+        :param rasterIdFieldName: Name of the id field for rasters (usually the primary key field)
+        :param rasterFieldName: Name of the field where rasters are stored (of type raster)
+        :param resampleMethod: Resampling algorithm used to reduce the rasters
+        """
+        if resampleMethod not in self.VALID_RESAMPLE_METHODS:
+            raise ValueError('RASTER CONVERSION ERROR: {0} is not a valid resampleMethod.'
+                             ' Please use either {1}'.format(resampleMethod, ', '.join(self.VALID_RESAMPLE_METHODS)))
+
+        factors = [int(factor) for factor in factors]
+
+        if not factors or min(factors) < 2:
+            raise ValueError('RASTER CONVERSION ERROR: overview factors must be integers greater than 1.')
+
+        overviewTable = self.getOverviewTableName(tableName)
+
+        # Indexes are created in the schema of their table, so the index name is never schema qualified
+        identifiers = {'table': tableName,
+                       'overviews': overviewTable,
+                       'index': '{0}_idx'.format(catalogName(overviewTable)[1]),
+                       'rasterId': rasterIdFieldName,
+                       'raster': rasterFieldName}
+
+        # The overview table takes the id and raster types from the source table
+        self._session.execute(prepareStatement('''
+                    CREATE TABLE IF NOT EXISTS {overviews} AS
+                    SELECT {rasterId} AS raster_id, 0 AS factor, CAST(0 AS double precision) AS cell_size, {raster} AS raster
+                    FROM {table}
+                    WITH NO DATA;
+                    ''', **identifiers))
+
+        self._session.execute(prepareStatement('''
+                    CREATE UNIQUE INDEX IF NOT EXISTS {index} ON {overviews} (raster_id, factor);
+                    ''', **identifiers))
+
+        if rasterIds is None:
+            condition = 'true'
+        else:
+            condition = 't.{rasterId} = ANY(:rasterIds)'
+
+        self._session.execute(prepareStatement('''
+                    DELETE FROM {overviews} AS o
+                    USING {table} AS t
+                    WHERE o.raster_id = t.{rasterId} AND ''' + condition + ';', **identifiers),
+                              {'rasterIds': coerceIds(rasterIds or [])})
+
+        self._session.execute(prepareStatement('''
+                    INSERT INTO {overviews} (raster_id, factor, cell_size, raster)
+                    SELECT t.{rasterId}, f.factor, abs(ST_ScaleX(o.raster)), o.raster
+                    FROM {table} AS t
+                    CROSS JOIN unnest(CAST(:factors AS integer[])) AS f(factor)
+                    CROSS JOIN LATERAL (
+                        SELECT ST_Resize(t.{raster},
+                                         greatest(ST_Width(t.{raster}) / f.factor, 1),
+                                         greatest(ST_Height(t.{raster}) / f.factor, 1),
+                                         CAST(:resampleMethod AS text)) AS raster
+                    ) AS o
+                    WHERE ''' + condition + ';', **identifiers),
+                              {'rasterIds': coerceIds(rasterIds or []),
+                               'factors': factors,
+                               'resampleMethod': resampleMethod})
+
+        self._overviewTables[tableName] = True
+
+    @classmethod
+    def getOverviewTableName(cls, tableName):
+        """
+        Return the name of the overview table of a raster table (e.g.: "rasters_overviews" for "rasters").
+        """
+        return cls._getSuffixedTableName(tableName, '_overviews')
+
+    @classmethod
+    def _getSuffixedTableName(cls, tableName, suffix):
+        """
+        Return the name of the table with the suffix added, inside the quotes of a quoted name
+        """
+        if tableName.endswith('"'):
+            return '{0}{1}"'.format(tableName[:-1], suffix)
+
+        return '{0}{1}'.format(tableName, suffix)
+
+    def hasOverviews(self, session, table):
+        """
+        Return True if overviews have been built for the table. Only tables with overviews are cached, so overviews
+        built by another process are found on the next call.
+        """
+        if not self._overviewTables.get(table):
+            self._overviewTables[table] = self._tableExists(session, self.getOverviewTableName(table))
+
+        return self._overviewTables[table]
+
+    @classmethod
+    def _tableExists(cls, session, tableName):
+        """
+        Return True if the table exists, in its schema if it is schema qualified or else in the current schema
+        """
+        statement = prepareStatement('''
+                    SELECT count(*)
+                    FROM information_schema.tables
+                    WHERE table_schema = COALESCE(CAST(:schema AS text), current_schema()) AND table_name = :table;
+                    ''')
+
+        schema, name = catalogName(tableName)
+        return session.execute(statement, {'schema': schema, 'table': name}).scalar() > 0
+
+    @sessionPerCall
+    def buildWgs84Copies(self, tableName, rasterIds=None, rasterIdFieldName='id', rasterFieldName='raster',
+                         resampleMethod='NearestNeighbour'):
+        """
+        Warp the rasters of a table to WGS 84 once and store the copies in the WGS 84 copy table of the table (see
+        getWgs84TableName). PNG renders with wgs84Copy=True then color the copies without warping them. Existing
+        copies of the rasters are replaced; build them again when the rasters change. Changes of the no data value
+        made by the converter are applied to the copies too.
+
+        :param tableName: Name of the table with the rasters
+        :param rasterIds: List of ids of the rasters to copy (default is all rasters in the table)
+        :param rasterIdFieldName: Name of the id field for rasters (usually the primary key field)
+        :param rasterFieldName: Name of the field where rasters are stored (of type raster)
+        :param resampleMethod: Resampling algorithm used to warp the rasters
+        """
+        if resampleMethod not in self.VALID_RESAMPLE_METHODS:
+            raise ValueError('RASTER CONVERSION ERROR: {0} is not a valid resampleMethod.'
+                             ' Please use either {1}'.format(resampleMethod, ', '.join(self.VALID_RESAMPLE_METHODS)))
+
+        wgs84Table = self.getWgs84TableName(tableName)
+
+        # Indexes are created in the schema of their table, so the index name is never schema qualified
+        identifiers = {'table': tableName,
+                       'wgs84': wgs84Table,
+                       'index': '{0}_idx'.format(catalogName(wgs84Table)[1]),
+                       'rasterId': rasterIdFieldName,
+                       'raster': rasterFieldName}
+
+        # The copy table takes the id and raster types from the source table
+        self._session.execute(prepareStatement('''
+                    CREATE TABLE IF NOT EXISTS {wgs84} AS
+                    SELECT {rasterId} AS raster_id, {raster} AS raster
+                    FROM {table}
+                    WITH NO DATA;
+                    ''', **identifiers))
+
+        self._session.execute(prepareStatement('''
+                    CREATE UNIQUE INDEX IF NOT EXISTS {index} ON {wgs84} (raster_id);
+                    ''', **identifiers))
+
+        if rasterIds is None:
+            condition = 'true'
+        else:
+            condition = 't.{rasterId} = ANY(:rasterIds)'
+
+        self._session.execute(prepareStatement('''
+                    DELETE FROM {wgs84} AS w
+                    USING {table} AS t
+                    WHERE w.raster_id = t.{rasterId} AND ''' + condition + ';', **identifiers),
+                              {'rasterIds': coerceIds(rasterIds or [])})
+
+        self._session.execute(prepareStatement('''
+                    INSERT INTO {wgs84} (raster_id, raster)
+                    SELECT t.{rasterId}, ST_Transform(t.{raster}, 4326, CAST(:resampleMethod AS text))
+                    FROM {table} AS t
+                    WHERE ''' + condition + ';', **identifiers),
+                              {'rasterIds': coerceIds(rasterIds or []),
+                               'resampleMethod': resampleMethod})
+
+        self._wgs84Tables[tableName] = True
+
+    @classmethod
+    def getWgs84TableName(cls, tableName):
+        """
+        Return the name of the WGS 84 copy table of a raster table (e.g.: "rasters_wgs84" for "rasters").
+        """
+        return cls._getSuffixedTableName(tableName, '_wgs84')
+
+    def hasWgs84Copies(self, session, table):
+        """
+        Return True if WGS 84 copies have been built for the table. Only tables with copies are cached, so copies
+        built by another process are found on the next call.
+        """
+        if not self._wgs84Tables.get(table):
+            self._wgs84Tables[table] = self._tableExists(session, self.getWgs84TableName(table))
+
+        return self._wgs84Tables[table]
+
+    def _checkWgs84Copies(self, session, tableName, rasterIds):
+        """
+        Raise a ValueError naming the rasters that have no WGS 84 copy
+        """
+        if not self.hasWgs84Copies(session, tableName):
+            raise ValueError('RASTER CONVERSION ERROR: WGS 84 copies have not been built for {0} '
+                             '(see buildWgs84Copies).'.format(tableName))
+
+        statement = prepareStatement('''
+                    SELECT raster_id
+                    FROM {wgs84}
+                    WHERE raster_id = ANY(:rasterIds);
+                    ''', wgs84=self.getWgs84TableName(tableName))
+
+        copiedIds = set(str(row[0]) for row in session.execute(statement, {'rasterIds': coerceIds(rasterIds)}))
+        missingIds = [str(rasterId) for rasterId in rasterIds if str(rasterId) not in copiedIds]
+
+        if missingIds:
+            raise ValueError('RASTER CONVERSION ERROR: WGS 84 copies have not been built for rasters {0} of {1} '
+                             '(see buildWgs84Copies).'.format(', '.join(missingIds), tableName))
+
+    def getRastersAsPngs(self, session, tableName, rasterIds, postGisRampString, rasterField='raster', rasterIdField='id',  cellSize=None, resampleMethod='NearestNeighbour',
+                         maxPixels=None, maxSize=None, bbox=None, bboxSrid=4326, palette=False, mappedColorRamp=None,
+                         warpMethod=None, wgs84Copy=False):
+        """
+        Return the raster in a PNG format. The result has the columns rid, png and the north, south, east and west
+        bounds of the PNG.
+
+        :param cellSize: Resample the rasters to cells of this size (in units of the raster spatial reference system)
+        :param maxPixels: Resample the rasters so width x height does not exceed this number of pixels
+        :param maxSize: Tuple of (maxWidth, maxHeight) in pixels to resample the rasters to fit within
+        Rasters are never enlarged by maxPixels or maxSize, and the limits apply before the rasters are warped to
+        WGS 84. cellSize cannot be combined with maxPixels or maxSize.
+        :param bbox: Bounding box (minX, minY, maxX, maxY) to clip the rasters to before rendering
+        :param bboxSrid: Spatial reference ID of the bounding box coordinates (default is 4326)
+        :param palette: Render the ramp index of each cell instead of its color. The png column is replaced by an
+                        indexed column with the 8BUI index raster in WKB (see getPalettePng). Requires mappedColorRamp.
+        :param mappedColorRamp: MappedColorRamp of the palette (postGisRampString is not used with palette)
+        :param warpMethod: Warp the value band to WGS 84 with this resampling method and color it afterwards, instead
+                           of warping the colored RGBA raster with bilinear blending (the default). Palette renders
+                           are always warped before they are colored, with nearest neighbour unless warpMethod is given.
+        :param wgs84Copy: Render the WGS 84 copies of the rasters made by buildWgs84Copies, so no warping is needed.
+                          cellSize cannot be combined with wgs84Copy. Copies are not updated when the rasters change,
+                          so they go stale until buildWgs84Copies is called again for the changed rasters.
+        """
+        joins, rasterExpression, parameters = self._getPngRenderParts(session, tableName, cellSize, resampleMethod,
+                                                                      maxPixels, maxSize, bbox, bboxSrid, wgs84Copy,
+                                                                      rasterIds)
+
+        if palette:
+            if mappedColorRamp is None:
+                raise ValueError('RASTER CONVERSION ERROR: palette rendering requires a mappedColorRamp.')
+
+            # Ramp indices must not be blended, so the values are warped before they are mapped to indices
+            parameters.update(self._getPaletteParameters(mappedColorRamp))
+            output = 'ST_AsBinary(rendered) As indexed'
+            renderExpression = ('ST_MapAlgebra(' + self._getWarpExpression(rasterExpression, wgs84Copy) + ', 1, '
+                                '\'8BUI\', CAST(:indexExpression AS text), '
+                                'CAST(:transparentIndex AS double precision))')
+        else:
+            output = 'ST_AsPNG(rendered) As png'
+            renderExpression = self._getColorMapExpression(rasterExpression, 'CAST(:rampString AS text)', warpMethod,
+                                                           wgs84Copy)
+
+        parameters.update(self._getWarpParameters(warpMethod))
+
+        # OFFSET 0 keeps the rendered raster from being computed once per output column
+        statement = prepareStatement('''
+                    SELECT rid, ''' + output + ''',
+                           ST_UpperLeftY(rendered) AS north,
+                           ST_UpperLeftY(rendered) + ST_ScaleY(rendered) * ST_Height(rendered) AS south,
+                           ST_UpperLeftX(rendered) + ST_ScaleX(rendered) * ST_Width(rendered) AS east,
+                           ST_UpperLeftX(rendered) AS west
+                    FROM (
+                    SELECT t.{rasterId} As rid, ''' + renderExpression + ''' As rendered
+                    FROM {table} AS t''' + joins + '''
+                    WHERE t.{rasterId} = ANY(:rasterIds)''' + self._bboxCondition('t.{raster}', bbox, session, tableName) + '''
+                    OFFSET 0
+                    ) AS foo;
+                    ''', raster=rasterField, table=tableName, rasterId=rasterIdField,
+                                     overviews=self.getOverviewTableName(tableName),
+                                     wgs84=self.getWgs84TableName(tableName))
+
+        result = session.execute(statement, dict(parameters,
+                                                 rasterIds=coerceIds(rasterIds),
+                                                 rampString=postGisRampString))
+        return result
+
+    def _getPngRenderParts(self, session, tableName, cellSize, resampleMethod, maxPixels, maxSize, bbox, bboxSrid,
+                           wgs84Copy=False, rasterIds=(), overrideNoData=False):
+        """
+        Validate the rendering options of getRastersAsPngs and return the SQL joins (on the raster table aliased as
+        t) and raster expression that resample and clip the raster, with their bound parameters. With wgs84Copy, the
+        raster is read from the WGS 84 copy table instead (aliased as w), which must have a copy of each of the
+        rasterIds. With overrideNoData, the noDataValue parameter is applied to the rasters read from the other tables
+        so they match t.{raster} (e.g.: the overviews in _getKmlPngInOneQuery, where the no data value is not written
+        to the tables).
+        """
         # Validate
-        if resampleMethod not in VALID_RESAMPLE_METHODS:
+        if resampleMethod not in self.VALID_RESAMPLE_METHODS:
             print('RASTER CONVERSION ERROR: {0} is not a valid resampleMethod.'
                   ' Please use either {1}'.format(resampleMethod,
-                                                  ', '.join(VALID_RESAMPLE_METHODS)))
+                                                  ', '.join(self.VALID_RESAMPLE_METHODS)))
 
         if cellSize is not None:
             if not self.isNumber(cellSize):
                 raise ValueError('RASTER CONVERSION ERROR: cellSize must be a number or None.')
 
-        # Convert raster ids into formatted string
-        rasterIdsString = '({0})'.format(', '.join(rasterIds))
+        if maxSize is not None and not (isinstance(maxSize, (tuple, list)) and len(maxSize) == 2):
+            raise ValueError('RASTER CONVERSION ERROR: maxSize must be given as (maxWidth, maxHeight).')
+
+        maxWidth, maxHeight = maxSize if maxSize is not None else (None, None)
+        bounded = maxPixels is not None or maxSize is not None
+
+        if bounded and cellSize is not None:
+            raise ValueError('RASTER CONVERSION ERROR: cellSize cannot be combined with maxPixels or maxSize.')
+
+        for limit in (maxPixels, maxWidth, maxHeight):
+            if limit is not None and not (self.isNumber(limit) and float(limit) >= 1):
+                raise ValueError('RASTER CONVERSION ERROR: maxPixels and maxSize must be numbers of at least 1.')
+
+        if wgs84Copy:
+            if cellSize is not None:
+                raise ValueError('RASTER CONVERSION ERROR: cellSize cannot be combined with wgs84Copy.')
+
+            self._checkWgs84Copies(session, tableName, rasterIds)
+
+        # Overviews are reduced copies of the source rasters, so they are not used with the WGS 84 copies
+        overviews = (cellSize is not None or bounded) and not wgs84Copy and self.hasOverviews(session, tableName)
+
+        # Assemble the raster expression from its source (full resolution, WGS 84 copy, overview or clipped) and the
+        # resampling
+        source = 't.{raster}'
+        joins = ''
+
+        if wgs84Copy:
+            joins += '''
+                        JOIN {wgs84} AS w ON w.raster_id = t.{rasterId}'''
+            source = self._overrideNoData('w.raster', overrideNoData)
+
+        if overviews and cellSize is not None:
+            # Coarsest overview that is still at least as fine as the requested cell size
+            joins += '''
+                        LEFT JOIN LATERAL (
+                            SELECT raster
+                            FROM {overviews}
+                            WHERE raster_id = t.{rasterId} AND cell_size <= CAST(:cellSize AS double precision)
+                            ORDER BY factor DESC
+                            LIMIT 1
+                        ) AS o ON true'''
+            source = 'COALESCE(' + self._overrideNoData('o.raster', overrideNoData) + ', t.{raster})'
+
+        if bbox is not None:
+            joins += '''
+                        CROSS JOIN LATERAL (
+                            SELECT ''' + self._clipToBbox(source, bbox) + ''' AS raster
+                        ) AS c'''
+            source = 'c.raster'
+
+        if bounded:
+            # Scale factor that fits the raster within the limits (LEAST ignores the limits that are NULL)
+            joins += '''
+                        CROSS JOIN LATERAL (
+                            SELECT ST_Width(''' + source + ''') AS width, ST_Height(''' + source + ''') AS height,
+                                   LEAST(1.0,
+                                         CAST(:maxWidth AS double precision) / ST_Width(''' + source + '''),
+                                         CAST(:maxHeight AS double precision) / ST_Height(''' + source + '''),
+                                         sqrt(CAST(:maxPixels AS double precision) / (CAST(ST_Width(''' + source + ''') AS double precision) * ST_Height(''' + source + ''')))) AS factor
+                        ) AS s'''
+
+            if overviews and bbox is None:
+                # Coarsest overview that is still at least as large as the requested size
+                joins += '''
+                        LEFT JOIN LATERAL (
+                            SELECT raster
+                            FROM {overviews}
+                            WHERE raster_id = t.{rasterId} AND factor <= 1.0 / s.factor
+                            ORDER BY factor DESC
+                            LIMIT 1
+                        ) AS o ON true'''
+                source = 'COALESCE(' + self._overrideNoData('o.raster', overrideNoData) + ', t.{raster})'
 
         if cellSize is not None:
-            statement = '''
-                        SELECT ST_AsPNG(ST_Transform(ST_ColorMap(ST_Rescale({0}, {5}, '{6}'), 1, '{4}'), 4326, 'Bilinear')) As png
-                        FROM {1}
-                        WHERE {2} IN {3};
-                        '''.format(rasterField, tableName, rasterIdField, rasterIdsString, postGisRampString, cellSize,
-                                   resampleMethod)
+            rasterExpression = 'ST_Rescale(' + source + ', CAST(:cellSize AS double precision), CAST(:resampleMethod AS text))'
+        elif bounded:
+            rasterExpression = ('CASE WHEN s.factor < 1 THEN ST_Resize(' + source + ', '
+                                'greatest(CAST(floor(s.width * s.factor) AS integer), 1), '
+                                'greatest(CAST(floor(s.height * s.factor) AS integer), 1), '
+                                'CAST(:resampleMethod AS text)) ELSE ' + source + ' END')
         else:
-            statement = '''
-                        SELECT ST_AsPNG(ST_Transform(ST_ColorMap({0}, 1, '{4}'), 4326, 'Bilinear')) As png
-                        FROM {1}
-                        WHERE {2} IN {3};
-                        '''.format(rasterField, tableName, rasterIdField, rasterIdsString, postGisRampString)
-        result = session.execute(statement)
-        return result
+            rasterExpression = source
+
+        parameters = dict(self._getBboxParameters(bbox, bboxSrid),
+                          cellSize=float(cellSize) if cellSize is not None else None,
+                          resampleMethod=resampleMethod,
+                          maxPixels=maxPixels,
+                          maxWidth=maxWidth,
+                          maxHeight=maxHeight)
+
+        return joins, rasterExpression, parameters
+
+    @classmethod
+    def getPalettePng(cls, indexedRaster, mappedColorRamp):
+        """
+        Return an 8-bit palette PNG of an index raster rendered by getRastersAsPngs with palette=True. The palette
+        holds the ramp colors and a transparent entry for the no data values.
+        :param indexedRaster: The indexed column of getRastersAsPngs (8BUI raster in WKB)
+        :param mappedColorRamp: The MappedColorRamp the raster was rendered with
+        :rtype: bytes
+        """
+        colors, alphas = mappedColorRamp.getPngPalette()
+        return PngWriter.getPalettePng(WKBRasterReader(indexedRaster), colors, alphas)
+
+    @classmethod
+    def _getPaletteParameters(cls, mappedColorRamp):
+        """
+        Return the bound parameters for the ST_MapAlgebra expression that maps values to ramp indices, looked up the
+        same way as MappedColorRamp.getColorForValue. No data values map to the entry after the ramp colors.
+        """
+        numColors = len(mappedColorRamp.colorRamp)
+
+        if numColors >= PngWriter.MAX_PALETTE_SIZE:
+            raise ValueError('RASTER CONVERSION ERROR: palette rendering supports color ramps of at most {0} '
+                             'colors.'.format(PngWriter.MAX_PALETTE_SIZE - 1))
+
+        # Numbers are written with repr so the expression keeps their full precision
+        indexExpression = ('CASE WHEN [rast] < {0} THEN 0 WHEN [rast] > {1} THEN {2} '
+                           'ELSE trunc({3} * [rast] + {4}) END').format(repr(float(mappedColorRamp.min)),
+                                                                        repr(float(mappedColorRamp.max)),
+                                                                        numColors - 1,
+                                                                        repr(float(mappedColorRamp.slope)),
+                                                                        repr(float(mappedColorRamp.intercept)))
+
+        return {'indexExpression': indexExpression,
+                'transparentIndex': numColors}
+
+    @classmethod
+    def _overrideNoData(cls, rasterExpression, overrideNoData):
+        """
+        Return the SQL for the raster with the noDataValue parameter as the no data value of band 1 (or the raster if
+        overrideNoData is False)
+        """
+        if not overrideNoData:
+            return rasterExpression
+
+        return 'ST_SetBandNoDataValue(' + rasterExpression + ', 1, CAST(:noDataValue AS double precision))'
+
+    @classmethod
+    def _getWarpExpression(cls, rasterExpression, wgs84Copy):
+        """
+        Return the SQL for the raster warped to WGS 84 with the warpMethod parameter (or the raster if it is a WGS 84
+        copy)
+        """
+        if wgs84Copy:
+            return rasterExpression
+
+        return 'ST_Transform(' + rasterExpression + ', 4326, CAST(:warpMethod AS text))'
+
+    @classmethod
+    def _getColorMapExpression(cls, rasterExpression, rampExpression, warpMethod, wgs84Copy):
+        """
+        Return the SQL for the colored raster in WGS 84. Without a warpMethod (or WGS 84 copy), the raster is colored
+        first and the RGBA raster is warped with bilinear blending. Otherwise the single value band is warped once and
+        colored afterwards.
+        """
+        if warpMethod is None and not wgs84Copy:
+            return 'ST_Transform(ST_ColorMap(' + rasterExpression + ', 1, ' + rampExpression + '), 4326, \'Bilinear\')'
+
+        return 'ST_ColorMap(' + cls._getWarpExpression(rasterExpression, wgs84Copy) + ', 1, ' + rampExpression + ')'
+
+    @classmethod
+    def _getWarpParameters(cls, warpMethod):
+        """
+        Return the bound parameters for _getWarpExpression (nearest neighbour by default)
+        """
+        if warpMethod is None:
+            warpMethod = 'NearestNeighbour'
+
+        if warpMethod not in cls.VALID_RESAMPLE_METHODS:
+            raise ValueError('RASTER CONVERSION ERROR: {0} is not a valid warpMethod.'
+                             ' Please use either {1}'.format(warpMethod, ', '.join(cls.VALID_RESAMPLE_METHODS)))
+
+        return {'warpMethod': warpMethod}
+
+    @classmethod
+    def _getColorParameters(cls, mappedColorRamp):
+        """
+        Return the bound parameters for _getColorExpression
+        """
+        return {'colors': ['#%02X%02X%02X' % tuple(rgb) for rgb in mappedColorRamp.colorRamp],
+                'minValue': float(mappedColorRamp.min),
+                'maxValue': float(mappedColorRamp.max),
+                'slope': float(mappedColorRamp.slope),
+                'intercept': float(mappedColorRamp.intercept)}
+
+    @classmethod
+    def _getColorExpression(cls, valueExpression):
+        """
+        Return the SQL for the '#RRGGBB' color of a value, looked up the same way as MappedColorRamp.getColorForValue
+        (arrays start at 1)
+        """
+        return ('''(CAST(:colors AS text[]))[
+                       CASE WHEN ''' + valueExpression + ''' < :minValue THEN 1
+                            WHEN ''' + valueExpression + ''' > :maxValue THEN cardinality(CAST(:colors AS text[]))
+                            ELSE CAST(trunc(:slope * ''' + valueExpression + ''' + :intercept) AS integer) + 1
+                       END]''')
+
+    @classmethod
+    def _getPrecision(cls, precision, default):
+        """
+        Return the number of decimal places for the geometry output functions
+        """
+        if precision is None:
+            return default
+
+        if int(precision) < 0:
+            raise ValueError('RASTER CONVERSION ERROR: precision must not be negative.')
+
+        return int(precision)
+
+    @classmethod
+    def _getSimplifyParameters(cls, tolerance, zoom):
+        """
+        Return the bound parameters for _simplifyGeometry. A zoom level is converted to the size of one 256 pixel
+        tile pixel in web mercator meters at that zoom.
+        """
+        if tolerance is not None and zoom is not None:
+            raise ValueError('RASTER CONVERSION ERROR: tolerance and zoom cannot be combined.')
+
+        if tolerance is not None:
+            if float(tolerance) < 0:
+                raise ValueError('RASTER CONVERSION ERROR: tolerance must not be negative.')
+            return {'tolerance': float(tolerance)}
+
+        if zoom is not None:
+            if int(zoom) < 0:
+                raise ValueError('RASTER CONVERSION ERROR: zoom must not be negative.')
+            return {'tolerance': cls.WEB_MERCATOR_RESOLUTION / (2 ** int(zoom))}
+
+        return {}
+
+    @classmethod
+    def _simplifyGeometry(cls, geometryExpression, tolerance, zoom):
+        """
+        Return the SQL for the geometries of the query simplified together as one coverage with ST_CoverageSimplify
+        (or the geometry if there is no tolerance or zoom). An edge shared by neighboring polygons is simplified once,
+        so the polygons stay valid and still share their edges exactly, without gaps or overlaps. The expression is a
+        window over all rows of the query, so the rows are only returned once all of them have been read. A tolerance
+        is in units of the geometry spatial reference system; with a zoom level the geometries are simplified in web
+        mercator. Requires PostGIS 3.4 or later (with GEOS 3.12 or later).
+        """
+        if tolerance is not None:
+            return 'ST_CoverageSimplify(' + geometryExpression + ', :tolerance) OVER ()'
+
+        if zoom is not None:
+            return 'ST_CoverageSimplify(ST_Transform(' + geometryExpression + ', 3857), :tolerance) OVER ()'
+
+        return geometryExpression
+
+    @classmethod
+    def _getBboxParameters(cls, bbox, bboxSrid):
+        """
+        Return the bound parameters for a bounding box given as (minX, minY, maxX, maxY)
+        """
+        if bbox is None:
+            return {}
+
+        if len(bbox) != 4:
+            raise ValueError('RASTER CONVERSION ERROR: bbox must be given as (minX, minY, maxX, maxY).')
+
+        minX, minY, maxX, maxY = [float(value) for value in bbox]
+
+        if minX >= maxX or minY >= maxY:
+            raise ValueError('RASTER CONVERSION ERROR: bbox minimums must be less than its maximums.')
+
+        return {'minX': minX, 'minY': minY, 'maxX': maxX, 'maxY': maxY, 'bboxSrid': int(bboxSrid)}
+
+    @classmethod
+    def _getBboxEnvelope(cls, rasterExpression):
+        """
+        Return the SQL for the bounding box parameters as a polygon in the spatial reference system of the raster
+        """
+        return ('ST_Transform(ST_MakeEnvelope(:minX, :minY, :maxX, :maxY, CAST(:bboxSrid AS integer)), '
+                'ST_SRID(' + rasterExpression + '))')
+
+    @classmethod
+    def _clipToBbox(cls, rasterExpression, bbox):
+        """
+        Return the SQL for the raster clipped to the bounding box parameters (or the raster if there is no bbox)
+        """
+        if bbox is None:
+            return rasterExpression
+
+        return 'ST_Clip(' + rasterExpression + ', ' + cls._getBboxEnvelope(rasterExpression) + ')'
+
+    def _bboxCondition(self, rasterExpression, bbox, session=None, table=None):
+        """
+        Return the SQL condition that skips rasters outside of the bounding box (or nothing if there is no bbox). When
+        the table has the metadata columns, the WGS 84 footprint of the raster column (e.g.: t.footprint for
+        t.{raster}) is compared with the bounding box first, which can use the footprint index. Rasters without a
+        footprint are only checked with ST_Intersects.
+        """
+        if bbox is None:
+            return ''
+
+        condition = ''
+
+        if table is not None and self.hasRasterMetadata(session, table):
+            footprint = rasterExpression.replace('{raster}', 'footprint')
+            condition += (' AND (' + footprint + ' && ST_Transform(ST_MakeEnvelope(:minX, :minY, :maxX, :maxY, '
+                          'CAST(:bboxSrid AS integer)), 4326) OR ' + footprint + ' IS NULL)')
+
+        return condition + ' AND ST_Intersects(' + rasterExpression + ', ' + self._getBboxEnvelope(rasterExpression) + ')'
 
     def isNumber(self, value):
         """
@@ -1115,5 +2674,5 @@ class RasterConverter(object):
             float(value)
             return True
 
-        except ValueError:
+        except (TypeError, ValueError):
             return False
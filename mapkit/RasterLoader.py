@@ -11,8 +11,10 @@
 import subprocess
 import os
 import json
+import binascii
 
 from .MapKitRaster import MapKitRaster
+from .sqlautils import prepareStatement, coerceIds
 from mapkit import Base
 
 from sqlalchemy.orm import sessionmaker
@@ -39,12 +41,14 @@ class RasterLoader(object):
         Returns the ids of the rasters loaded successfully in the same order
         as the list passed in.
         '''
-        # Create table if necessary
+        # Create table if necessary and add the columns of newer versions to an existing table
         Base.metadata.create_all(self._engine)
+        self.upgradeRasterTable(self._engine)
 
         # Create a session
         Session = sessionmaker(bind=self._engine)
         session = Session()
+        mapKitRasters = []
 
         for raster in rasters:
             # Must read in using the raster2pgsql commandline tool.
@@ -77,39 +81,236 @@ class RasterLoader(object):
 
             # Add to session
             session.add(mapKitRaster)
+            mapKitRasters.append(mapKitRaster)
+
+        # Assign ids so the metadata can be derived in the database
+        session.flush()
+        rasterIds = [mapKitRaster.id for mapKitRaster in mapKitRasters]
+
+        if rasterIds:
+            self.updateRasterMetadata(session=session,
+                                      tableName=MapKitRaster.__tablename__,
+                                      rasterIds=rasterIds)
 
         session.commit()
 
+        return rasterIds
+
+    @classmethod
+    def upgradeRasterTable(cls, engine):
+        """
+        Add the columns and indexes of MapKitRaster that are missing from an existing map_kit_rasters table
+        (create_all only creates missing tables) and populate the metadata columns of the rasters already in the
+        table. Does nothing when the table is up to date, so it is safe to call more than once.
+        :param engine: SQLAlchemy engine bound to a PostGIS enabled database
+        """
+        table = MapKitRaster.__table__
+
+        with engine.begin() as connection:
+            statement = prepareStatement('''
+                        SELECT column_name
+                        FROM information_schema.columns
+                        WHERE table_schema = current_schema() AND table_name = :table;
+                        ''')
+            existingColumns = set(row[0] for row in connection.execute(statement, {'table': table.name}))
+            missingColumns = [column for column in table.columns if column.name not in existingColumns]
+
+            if not missingColumns:
+                return
+
+            for column in missingColumns:
+                connection.execute(prepareStatement('ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} ' +
+                                                    column.type.compile(dialect=engine.dialect) + ';',
+                                                    table=table.name, column=column.name))
+
+            for index in table.indexes:
+                using = index.dialect_options['postgresql']['using'] or 'btree'
+                columnNames = [column.name for column in index.columns]
+                identifiers = dict(('column{0}'.format(n), name) for n, name in enumerate(columnNames))
+                connection.execute(prepareStatement('CREATE INDEX IF NOT EXISTS {index} ON {table} USING ' + using +
+                                                    ' (' + ', '.join('{{column{0}}}'.format(n) for n in range(len(columnNames))) + ');',
+                                                    index=index.name, table=table.name, **identifiers))
+
+            # Derive the metadata of the rasters loaded before the columns existed
+            statement = prepareStatement('''
+                        SELECT id
+                        FROM {table}
+                        WHERE width IS NULL;
+                        ''', table=table.name)
+            rasterIds = [row[0] for row in connection.execute(statement)]
+
+            if rasterIds:
+                cls.updateRasterMetadata(session=connection, tableName=table.name, rasterIds=rasterIds)
+
+    @classmethod
+    def updateRasterMetadata(cls, session, tableName, rasterIds, rasterIdFieldName='id', rasterFieldName='raster'):
+        """
+        Compute the metadata and statistics of the given rasters once and store them in the metadata columns of the
+        table (see MapKitRaster). RasterConverter reads these columns instead of deriving them from the raster on
+        every render. Can also be used to populate the columns of rasters that were loaded by other means.
+        :param session: SQLAlchemy session (or connection) bound to a PostGIS enabled database
+        :param tableName: Name of the table with the raster and metadata columns
+        :param rasterIds: List of ids of the rasters to update
+        :param rasterIdFieldName: Name of the id field for rasters (usually the primary key field)
+        :param rasterFieldName: Name of the field where rasters are stored (of type raster)
+        """
+        # Footprint is the extent of the raster in WGS 84, which is the extent of the KML overlays. The envelope is
+        # transformed instead of the raster (no resampling); it is densified first so that edges that curve in WGS 84
+        # are followed.
+        statement = prepareStatement('''
+                    UPDATE {table} AS r
+                    SET width = m.width, height = m.height, srid = m.srid,
+                        upper_left_x = m.upperleftx, upper_left_y = m.upperlefty,
+                        scale_x = m.scalex, scale_y = m.scaley, skew_x = m.skewx, skew_y = m.skewy,
+                        no_data_value = m.nodata, min_value = (m.stats).min, max_value = (m.stats).max,
+                        footprint = m.footprint
+                    FROM (
+                    SELECT {rasterId} AS rid, (ST_MetaData({raster})).*,
+                           ST_BandNoDataValue({raster}, 1) AS nodata,
+                           ST_SummaryStats({raster}, 1, true) AS stats,
+                           CASE WHEN ST_SRID({raster}) > 0
+                                THEN ST_Envelope(ST_Transform(ST_Segmentize(ST_Envelope({raster}),
+                                     GREATEST(ST_Width({raster}) * abs(ST_ScaleX({raster})),
+                                              ST_Height({raster}) * abs(ST_ScaleY({raster}))) / 16), 4326))
+                           END AS footprint
+                    FROM {table}
+                    WHERE {rasterId} = ANY(:rasterIds)
+                    ) AS m
+                    WHERE r.{rasterId} = m.rid;
+                    ''', table=tableName, rasterId=rasterIdFieldName, raster=rasterFieldName)
+
+        session.execute(statement, {'rasterIds': coerceIds(rasterIds)})
+
     @classmethod
-    def rasterToWKB(cls, rasterPath, srid, noData, raster2pgsql):
+    def rasterToWKB(cls, rasterPath, srid, noData, raster2pgsql, binary=False):
         """
         Accepts a raster file and converts it to Well Known Binary text using the raster2pgsql
         executable that comes with PostGIS. This is the format that rasters are stored in a
         PostGIS database.
+        :param rasterPath: Path to the raster file to convert
+        :param srid: SRID of the raster
+        :param noData: Value of cells to be considered as cells containing no data
+        :param raster2pgsql: Path to the raster2pgsql executable
+        :param binary: Return the decoded binary (bytearray) instead of the hex string. Defaults to False.
         """
-        raster2pgsqlProcess = subprocess.Popen([raster2pgsql,
-                                                '-s', srid,
-                                                '-N', noData,
-                                                rasterPath,
-                                                'n_a'],stdout=subprocess.PIPE)
+        tiles = cls.iterRasterToWKB(rasterPath, srid, noData, raster2pgsql, binary=binary)
+
+        try:
+            wellKnownBinary = next(tiles)
+        except StopIteration:
+            raise IOError('RASTER LOAD ERROR: raster2pgsql did not produce a raster for "{0}".'.format(rasterPath))
+        finally:
+            tiles.close()
+
+        return wellKnownBinary
+
+    @classmethod
+    def iterRasterToWKB(cls, rasterPath, srid, noData, raster2pgsql, tileSize=None, binary=False, chunkSize=65536):
+        """
+        Generator that runs raster2pgsql and yields the Well Known Binary of each raster (or tile) as it is read from
+        the output of the process. The output is scanned incrementally, so only one copy of each raster is held in
+        memory at a time.
+        :param rasterPath: Path to the raster file to convert
+        :param srid: SRID of the raster
+        :param noData: Value of cells to be considered as cells containing no data
+        :param raster2pgsql: Path to the raster2pgsql executable
+        :param tileSize: Tile size in "WIDTHxHEIGHT" format (e.g.: "100x100"). Each tile is yielded separately. Defaults to None (one raster).
+        :param binary: Yield the decoded binary (bytearray) instead of the hex string. Defaults to False.
+        :param chunkSize: Number of bytes to read from the process at a time
+        """
+        command = [raster2pgsql, '-s', str(srid), '-N', str(noData)]
+
+        if tileSize:
+            command.extend(['-t', str(tileSize)])
+
+        command.extend([rasterPath, 'n_a'])
+
+        raster2pgsqlProcess = subprocess.Popen(command, stdout=subprocess.PIPE)
 
         # This commandline tool generates the SQL to load the raster into the database
         # However, we want to use SQLAlchemy to load the values into the database.
         # We do this by extracting the value from the sql that is generated.
-        sql, error = raster2pgsqlProcess.communicate()
-        if sql:
-            # This esoteric line is used to extract only the value of the raster (which is stored as a Well Know Binary string)
-            # Example of Output:
-            # BEGIN;
-            # INSERT INTO "idx_index_maps" ("rast") VALUES ('0100...56C096CE87'::raster);
-            # END;
-            # The WKB is wrapped in single quotes. Splitting on single quotes isolates it as the
-            # second item in the resulting list.
-            wellKnownBinary = sql.split("'")[1]
-        else:
-            print(error)
-            raise
-        return wellKnownBinary
+        # Example of Output:
+        # BEGIN;
+        # INSERT INTO "idx_index_maps" ("rast") VALUES ('0100...56C096CE87'::raster);
+        # END;
+        # The WKB is wrapped in single quotes, so everything between a pair of single quotes is one raster (or tile).
+        try:
+            for wellKnownBinary in cls._scanQuotedPayloads(raster2pgsqlProcess.stdout, binary, chunkSize):
+                yield wellKnownBinary
+
+            raster2pgsqlProcess.wait()
+        finally:
+            if raster2pgsqlProcess.poll() is None:
+                raster2pgsqlProcess.kill()
+            raster2pgsqlProcess.stdout.close()
+            raster2pgsqlProcess.wait()
+
+        if raster2pgsqlProcess.returncode != 0:
+            raise IOError('RASTER LOAD ERROR: raster2pgsql exited with code {0} while reading "{1}".'.format(
+                raster2pgsqlProcess.returncode, rasterPath))
+
+    @staticmethod
+    def _scanQuotedPayloads(stream, binary, chunkSize):
+        """
+        Read the stream in fixed size chunks and yield the content of each single quoted literal.
+        The chunk buffer is allocated once and reused. Each literal is copied into its own growing bytearray instead
+        of a buffer preallocated from the raster header: the size of a raster depends on the pixel type of each of
+        its bands, which is only known once each band is reached. bytearray grows by over-allocating, so the
+        copies stay amortized linear. Text literals are then copied once more by decode, because they are returned
+        as str.
+        """
+        QUOTE = ord("'")
+        chunk = bytearray(chunkSize)
+        chunkView = memoryview(chunk)
+        payload = None
+        carry = b''
+
+        while True:
+            numBytes = stream.readinto(chunkView)
+
+            if not numBytes:
+                break
+
+            position = 0
+
+            while position < numBytes:
+                if payload is None:
+                    # Look for the opening quote
+                    start = chunk.find(QUOTE, position, numBytes)
+
+                    if start < 0:
+                        break
+
+                    payload = bytearray()
+                    carry = b''
+                    position = start + 1
+                    continue
+
+                # Look for the closing quote
+                end = chunk.find(QUOTE, position, numBytes)
+                stop = numBytes if end < 0 else end
+
+                if binary:
+                    # Decode hex in even length pieces, carrying the odd nibble over to the next chunk
+                    hexPiece = carry + chunkView[position:stop].tobytes()
+                    even = len(hexPiece) - (len(hexPiece) % 2)
+                    payload.extend(binascii.unhexlify(hexPiece[:even]))
+                    carry = hexPiece[even:]
+                else:
+                    payload.extend(chunkView[position:stop])
+
+                if end < 0:
+                    break
+
+                position = end + 1
+
+                if binary:
+                    yield payload
+                else:
+                    yield payload.decode('ascii')
+
+                payload = None
 
     @classmethod
     def grassAsciiRasterToWKB(cls, session, grassRasterPath, srid, noData=0, dataType='32BF'):
@@ -163,13 +364,11 @@ class RasterLoader(object):
         cellSizeX = int(abs(west - east) / columns)
         cellSizeY = -1 * cellSizeX
 
-        # Assemble the data array string
-        dataArrayList = []
+        # Assemble the data array (GRASS null cells "*" become NULL)
+        dataArray = []
 
         for line in rasterLines[NUM_HEADER_LINES:len(rasterLines)]:
-            dataArrayList.append('[{0}]'.format(', '.join(line.split())))
-
-        dataArrayString = '[{0}]'.format(', '.join(dataArrayList))
+            dataArray.append([None if value == '*' else float(value) for value in line.split()])
 
         # Create well known binary raster
         wellKnownBinary = cls.makeSingleBandWKBRaster(session=session,
@@ -178,7 +377,7 @@ class RasterLoader(object):
                                                       cellSizeX=cellSizeX, cellSizeY=cellSizeY,
                                                       skewX=0, skewY=0,
                                                       srid=srid,
-                                                      dataArray=dataArrayString,
+                                                      dataArray=dataArray,
                                                       noDataValue=noData,
                                                       dataType=dataType)
 
@@ -204,19 +403,11 @@ class RasterLoader(object):
         :param dataArray: 2-dimensional list of values or a string representation of a 2-dimensional list that will be used to populate the raster values
         :param dataType: Data type of the values of the raster. One of "1BB", "2BUI", "4BUI", "8BSI", "8BUI", "16BSI", "16BUI", "32BSI", "32BUI", "32BF", or "64BF". Defaults to "32BF".
         """
-        # Stringify the data array
+        # Parse the data array if given as a string
         if isinstance(dataArray, str):
-            dataArrayString = dataArray
-        else:
-            dataArrayString = json.dumps(dataArray)
+            dataArray = json.loads(dataArray)
 
         # Validate
-        if initialValue is None:
-            initialValue = 'NULL'
-
-        if noDataValue is None:
-            noDataValue = 'NULL'
-
         if dataType not in cls.RASTER_DATA_TYPES:
             raise ValueError('"{}" is not a valid raster data type. Must be one of "{}"'.format(
                 dataType, '" ,"'.join(cls.RASTER_DATA_TYPES)))
@@ -227,29 +418,33 @@ class RasterLoader(object):
             cellSizeY = -1 * cellSizeY
 
         # Create the SQL statement
-        statement = '''
+        statement = prepareStatement('''
                     SELECT ST_SetValues(
                         ST_AddBand(
-                            ST_MakeEmptyRaster({0}::integer, {1}::integer, {2}, {3}, {4}, {5}, {6}, {7}, {8}::integer),
-                            1::integer, '{12}'::text, {9}::double precision, {10}::double precision
+                            ST_MakeEmptyRaster(CAST(:width AS integer), CAST(:height AS integer),
+                                               CAST(:upperLeftX AS double precision), CAST(:upperLeftY AS double precision),
+                                               CAST(:cellSizeX AS double precision), CAST(:cellSizeY AS double precision),
+                                               CAST(:skewX AS double precision), CAST(:skewY AS double precision),
+                                               CAST(:srid AS integer)),
+                            1, CAST(:dataType AS text), CAST(:initialValue AS double precision), CAST(:noDataValue AS double precision)
                         ),
-                        1, 1, 1, ARRAY{11}::double precision[][]
+                        1, 1, 1, CAST(:dataArray AS double precision[][])
                     );
-                    '''.format(width,
-                               height,
-                               upperLeftX,
-                               upperLeftY,
-                               cellSizeX,
-                               cellSizeY,
-                               skewX,
-                               skewY,
-                               srid,
-                               initialValue,
-                               noDataValue,
-                               dataArrayString,
-                               dataType)
-
-        result = session.execute(statement)
+                    ''')
+
+        result = session.execute(statement, {'width': width,
+                                             'height': height,
+                                             'upperLeftX': upperLeftX,
+                                             'upperLeftY': upperLeftY,
+                                             'cellSizeX': cellSizeX,
+                                             'cellSizeY': cellSizeY,
+                                             'skewX': skewX,
+                                             'skewY': skewY,
+                                             'srid': srid,
+                                             'initialValue': initialValue,
+                                             'noDataValue': noDataValue,
+                                             'dataArray': dataArray,
+                                             'dataType': dataType})
 
         # Extract result
         wellKnownBinary = ''
@@ -0,0 +1,173 @@
+"""
+********************************************************************************
+* Name: WKBRasterReader
+* Author: Nathan Swain
+* Created On: October 18, 2026
+* Copyright: (c) Brigham Young University 2013
+* License: BSD 2-Clause
+********************************************************************************
+"""
+import struct
+import sys
+from array import array
+
+try:
+    import numpy
+    numpy_enabled = True
+except ImportError:
+    numpy_enabled = False
+
+
+class WKBRasterBand(object):
+    """
+    Object containing one band of a Well Known Binary raster
+    """
+
+    def __init__(self, pixelType, noDataValue, data, width, height, swap):
+        self.pixelType = pixelType
+        self.noDataValue = noDataValue
+        self.width = width
+        self.height = height
+        self._data = data
+        self._swap = swap
+
+    def __repr__(self):
+        return '<WKBRasterBand PixelType={0}, NoDataValue={1}, Width={2}, Height={3}>'.format(self.pixelType,
+                                                                                             self.noDataValue,
+                                                                                             self.width,
+                                                                                             self.height)
+
+    def getRow(self, rowIndex):
+        """
+        Return the values of one row of the band
+        :rtype: array.array
+        """
+        typeCode = WKBRasterReader.PIXEL_TYPES[self.pixelType][1]
+        rowSize = self.width * array(typeCode).itemsize
+        start = rowIndex * rowSize
+
+        row = array(typeCode)
+        row.frombytes(self._data[start:start + rowSize])
+
+        if self._swap:
+            row.byteswap()
+
+        return row
+
+    def iterRows(self):
+        """
+        Generator that yields the values of each row of the band, top to bottom
+        """
+        for rowIndex in range(self.height):
+            yield self.getRow(rowIndex)
+
+    def getArray(self):
+        """
+        Return the values of the band as a height x width NumPy array (requires NumPy)
+        :rtype: numpy.ndarray
+        """
+        if not numpy_enabled:
+            raise ImportError('RASTER READ ERROR: NumPy is required to read a band as an array.')
+
+        typeCode = WKBRasterReader.PIXEL_TYPES[self.pixelType][1]
+        values = numpy.frombuffer(self._data, dtype=numpy.dtype(typeCode)).reshape(self.height, self.width)
+
+        if self._swap:
+            values = values.byteswap()
+
+        return values
+
+
+class WKBRasterReader(object):
+    """
+    Reads the header and bands of a PostGIS raster in Well Known Binary format (e.g.: the result of ST_AsBinary)
+    without copying the pixel data.
+    """
+    # Pixel type code: (PostGIS name, array type code)
+    PIXEL_TYPES = {0: ('1BB', 'B'),
+                   1: ('2BUI', 'B'),
+                   2: ('4BUI', 'B'),
+                   3: ('8BSI', 'b'),
+                   4: ('8BUI', 'B'),
+                   5: ('16BSI', 'h'),
+                   6: ('16BUI', 'H'),
+                   7: ('32BSI', 'i'),
+                   8: ('32BUI', 'I'),
+                   10: ('32BF', 'f'),
+                   11: ('64BF', 'd')}
+
+    HEADER_FORMAT = 'HHddddddiHH'
+    IS_OFFLINE = 0x80
+    HAS_NO_DATA = 0x40
+
+    def __init__(self, wellKnownBinary):
+        """
+        Constructor
+        :param wellKnownBinary: bytes, bytearray or memoryview of the raster
+        """
+        data = memoryview(wellKnownBinary)
+
+        endian = '<' if data[0] == 1 else '>'
+        swap = (endian == '<') != (sys.byteorder == 'little')
+        headerSize = struct.calcsize(endian + self.HEADER_FORMAT)
+
+        (self.version, numBands,
+         self.scaleX, self.scaleY, self.upperLeftX, self.upperLeftY, self.skewX, self.skewY,
+         self.srid, self.width, self.height) = struct.unpack_from(endian + self.HEADER_FORMAT, data, 1)
+
+        self.bands = []
+        offset = 1 + headerSize
+
+        for bandIndex in range(numBands):
+            flags = data[offset]
+            pixelType = flags & 0x0F
+            offset += 1
+
+            if flags & self.IS_OFFLINE:
+                raise ValueError('RASTER READ ERROR: out-db raster bands are not supported.')
+
+            if pixelType not in self.PIXEL_TYPES:
+                raise ValueError('RASTER READ ERROR: unknown pixel type {0}.'.format(pixelType))
+
+            typeCode = self.PIXEL_TYPES[pixelType][1]
+            itemSize = array(typeCode).itemsize
+
+            noDataValue = struct.unpack_from(endian + typeCode, data, offset)[0]
+            offset += itemSize
+
+            if not (flags & self.HAS_NO_DATA):
+                noDataValue = None
+
+            bandSize = self.width * self.height * itemSize
+            self.bands.append(WKBRasterBand(pixelType=pixelType,
+                                            noDataValue=noDataValue,
+                                            data=data[offset:offset + bandSize],
+                                            width=self.width,
+                                            height=self.height,
+                                            swap=swap))
+            offset += bandSize
+
+    def __repr__(self):
+        return '<WKBRasterReader Width={0}, Height={1}, SRID={2}, Bands={3}>'.format(self.width,
+                                                                                    self.height,
+                                                                                    self.srid,
+                                                                                    len(self.bands))
+
+    def getBand(self, bandNumber=1):
+        """
+        Return a band by number (starting at 1, like PostGIS)
+        :rtype: WKBRasterBand
+        """
+        return self.bands[bandNumber - 1]
+
+    def getExtent(self):
+        """
+        Return the north, south, east and west bounds of the raster (assumes no skew)
+        :rtype: tuple of floats
+        """
+        north = self.upperLeftY
+        south = self.upperLeftY + (self.scaleY * self.height)
+        east = self.upperLeftX + (self.scaleX * self.width)
+        west = self.upperLeftX
+
+        return north, south, east, west
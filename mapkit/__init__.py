@@ -69,3 +69,28 @@ def lookupSpatialReferenceID(wellKnownText):
                     "reference ID, because there is no internet connection. "
                     "Please check connection and try again.")
     return code
+
+
+def formatCoordinate(value, precision=None):
+    """
+    Format a coordinate for KML output.
+
+    Args:
+        value (float): The coordinate.
+        precision (int): Number of decimal places to round to (trailing zeros are dropped). Defaults to full precision.
+
+    Returns:
+        str: The formatted coordinate.
+    """
+    if precision is None:
+        return str(value)
+
+    text = '{0:.{1}f}'.format(float(value), int(precision))
+
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+
+    if text == '-0':
+        text = '0'
+
+    return text
@@ -0,0 +1,96 @@
+'''
+********************************************************************************
+* Name: sqlautils
+* Author: Nathan Swain
+* Created On: October 18, 2026
+* Copyright: (c) Brigham Young University 2013
+* License: BSD 2-Clause
+********************************************************************************
+'''
+
+import functools
+import re
+
+from sqlalchemy import text
+
+# Identifiers that PostgreSQL accepts without quotes (these are case folded, as before)
+UNQUOTED_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_$]*$')
+QUOTED_IDENTIFIER = re.compile(r'^"(?:[^"]|"")+"$')
+
+# Number of compiled statements kept (least recently used statements are dropped first)
+STATEMENT_CACHE_SIZE = 512
+
+
+def quoteIdentifier(identifier, alwaysQuote=False):
+    '''
+    Return the identifier safe for use in a SQL statement. Schema qualified names (e.g.: "schema.table") are quoted
+    part by part. Plain identifiers are left as they are so that PostgreSQL case folding is unchanged; anything else
+    is wrapped in double quotes with embedded quotes escaped. With alwaysQuote, plain identifiers are quoted too so
+    their case is kept (e.g.: "MyTable" instead of mytable).
+    '''
+    quotedParts = []
+
+    for part in str(identifier).split('.'):
+        if QUOTED_IDENTIFIER.match(part) or (not alwaysQuote and UNQUOTED_IDENTIFIER.match(part)):
+            quotedParts.append(part)
+        else:
+            quotedParts.append('"{0}"'.format(part.replace('"', '""')))
+
+    return '.'.join(quotedParts)
+
+
+def catalogName(identifier):
+    '''
+    Return the (schema, name) of an identifier as PostgreSQL stores them in the catalog (e.g.: in
+    information_schema.tables): unquoted parts are case folded and quoted parts are unquoted. The schema is None when
+    the identifier is not schema qualified.
+    '''
+    parts = []
+
+    for part in str(identifier).split('.'):
+        if QUOTED_IDENTIFIER.match(part):
+            parts.append(part[1:-1].replace('""', '"'))
+        elif UNQUOTED_IDENTIFIER.match(part):
+            parts.append(part.lower())
+        else:
+            parts.append(part)
+
+    if len(parts) > 1:
+        return parts[-2], parts[-1]
+
+    return None, parts[-1]
+
+
+def prepareStatement(template, alwaysQuote=False, **identifiers):
+    '''
+    Return a text() statement for the template with the identifiers (table and column names) quoted and substituted
+    (see quoteIdentifier for alwaysQuote). Values must be passed as bound parameters (e.g.: ":rasterId") when the
+    statement is executed. Statements are cached (the STATEMENT_CACHE_SIZE most recently used), so the same SQL text
+    is sent on every call and drivers that prepare statements on the server (e.g.: psycopg 3, asyncpg) can reuse the
+    plan.
+    '''
+    return _compileStatement(template, tuple(sorted(identifiers.items())), alwaysQuote)
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _compileStatement(template, identifiers, alwaysQuote):
+    '''
+    Return the text() statement of prepareStatement for the template and the (name, value) pairs of the identifiers
+    '''
+    quoted = dict((name, quoteIdentifier(value, alwaysQuote)) for name, value in identifiers)
+    return text(template.format(**quoted))
+
+
+def coerceIds(ids):
+    '''
+    Return a list of ids for binding as an array parameter (e.g.: "id = ANY(:rasterIds)"). Numeric strings are
+    converted to integers so the array type matches integer id columns.
+    '''
+    coerced = []
+
+    for value in ids:
+        if isinstance(value, str) and value.lstrip('-').isdigit():
+            value = int(value)
+        coerced.append(value)
+
+    return coerced
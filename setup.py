@@ -1,7 +1,7 @@
 from setuptools import setup, find_packages
 
 requires = [
-    'sqlalchemy',
+    'sqlalchemy>=1.4',
     'requests',
     'epsg-ident'
 ]
@@ -23,6 +23,7 @@ setup(name='mapkit',
       packages=find_packages(),
       include_package_data=True,
       install_requires=requires,
+      extras_require={'async': ['asyncpg'], 'numpy': ['numpy']},
       tests_require=requires,
       test_suite=''
 )